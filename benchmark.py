@@ -0,0 +1,146 @@
+"""Нагрузочная проверка основных сценариев бота на локальном хранилище SQLite.
+
+Запуск: python benchmark.py --users 1000 --capsules 20 --recipients 5
+Сжатие и шифрование содержимого: python benchmark.py --crypto
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+import timeit
+
+os.environ.setdefault("STORAGE_BACKEND", "sqlite")
+os.environ.setdefault("TELEGRAM_TOKEN", "benchmark")
+os.environ.setdefault("ENCRYPTION_KEY", "benchmark-encryption-key")
+os.environ.setdefault("REDIS_URL", "redis://localhost:6379/0")
+
+import database
+import crypto
+from crypto import encrypt_data_aes, decrypt_content
+from content import items_to_legacy, encode_content, decode_content
+
+def make_content(index: int) -> list:
+    """Содержимое капсулы: немного текста и несколько вложений."""
+    return (
+        [('text', f"Письмо в будущее №{index}. " * 20)]
+        + [('photos', f"photo-file-id-{index}-{n}") for n in range(3)]
+        + [('documents', f"document-file-id-{index}")]
+    )
+
+def seed(users: int, capsules: int, recipients: int):
+    """Заполнение хранилища пользователями, капсулами и получателями напрямую через SQL."""
+    conn = database.get_backend().conn
+    with conn:
+        conn.executemany(
+            "insert into users (telegram_id, username, chat_id, capsule_counter) values (?, ?, ?, ?)",
+            [(1000 + n, f"user{n}", 5000 + n, capsules) for n in range(users)]
+        )
+        for user_id in range(1, users + 1):
+            for number in range(1, capsules + 1):
+                encrypted, manifest = database._seal_content(make_content(number))
+                capsule_id = conn.execute(
+                    "insert into capsules (creator_id, title, content_manifest, user_capsule_number) "
+                    "values (?, ?, ?, ?)",
+                    (user_id, f"Капсула {number}", json.dumps(manifest), number)
+                ).lastrowid
+                conn.execute(
+                    "insert into capsule_contents (capsule_id, content) values (?, ?)",
+                    (capsule_id, encrypted)
+                )
+                conn.executemany(
+                    "insert or ignore into recipients (capsule_id, recipient_username) values (?, ?)",
+                    [(capsule_id, f"user{random.randrange(users)}") for _ in range(recipients)]
+                )
+
+async def list_page(telegram_id: int, capsule_id: int):
+    database.begin_unit_of_work()
+    await database.get_user_capsules_page(telegram_id, 10)
+
+async def preview(telegram_id: int, capsule_id: int):
+    database.begin_unit_of_work()
+    await database.get_user_by_telegram_id(telegram_id)
+    await database.get_capsule_meta(capsule_id)
+    await database.get_capsule_content(capsule_id)
+
+async def prepare_delivery(telegram_id: int, capsule_id: int):
+    database.begin_unit_of_work()
+    await database.get_delivery_bundle(capsule_id)
+
+async def create(telegram_id: int, capsule_id: int):
+    database.begin_unit_of_work()
+    user = await database.add_user(f"user{telegram_id - 1000}", telegram_id, telegram_id + 4000)
+    number = await database.generate_unique_capsule_number(user['id'])
+    new_id = await database.create_capsule(user['id'], "Новая капсула", make_content(number), number)
+    await database.add_recipients(new_id, ["user1", "user2", "user3"])
+
+FLOWS = {
+    "Страница списка капсул": list_page,
+    "Предпросмотр капсулы": preview,
+    "Подготовка отправки": prepare_delivery,
+    "Создание капсулы": create
+}
+
+async def run(args):
+    started = time.perf_counter()
+    seed(args.users, args.capsules, args.recipients)
+    print(f"Хранилище заполнено за {time.perf_counter() - started:.2f} с: "
+          f"{args.users} пользователей, {args.users * args.capsules} капсул")
+    for name, flow in FLOWS.items():
+        database.reset_query_stats()
+        started = time.perf_counter()
+        for _ in range(args.iterations):
+            user = random.randrange(args.users)
+            await flow(1000 + user, user * args.capsules + random.randint(1, args.capsules))
+        elapsed = time.perf_counter() - started
+        queries = sum(database.get_query_stats().values())
+        print(f"{name}: {elapsed / args.iterations * 1000:.3f} мс, "
+              f"{queries / args.iterations:.1f} запросов на операцию {database.get_query_stats()}")
+    await database.close_session()
+
+def sample_contents() -> dict:
+    """Типичные капсулы: короткая записка, длинное письмо и капсула из одних вложений."""
+    letter = " ".join(random.choice(["привет", "будущий", "я", "помню", "этот", "день", "и", "надеюсь", "что", "всё", "хорошо"]) for _ in range(3000))
+    return {
+        "Короткая записка": [('text', "Открой через год!")],
+        "50 коротких заметок": [('text', f"Заметка №{n}: открой через год!") for n in range(50)],
+        "Длинное письмо": [('text', letter), ('photos', os.urandom(40).hex()), ('text', letter[:2000])],
+        "Только вложения": [('photos', os.urandom(40).hex()) for _ in range(10)] + [('videos', os.urandom(40).hex()) for _ in range(3)]
+    }
+
+def measure(func, iterations: int) -> float:
+    """Время вызова в микросекундах: лучшее из нескольких серий, чтобы меньше зависеть от шума."""
+    return min(timeit.repeat(func, number=iterations, repeat=5)) / iterations * 1e6
+
+def run_crypto(iterations: int):
+    """Размер и скорость форматов содержимого и алгоритмов сжатия."""
+    algorithms = ["none", "zlib"] + (["zstd"] if crypto.zstandard else [])
+    for name, items in sample_contents().items():
+        # После дешифрования оба формата — байты, поэтому JSON тоже разбирается из байтов
+        legacy = json.dumps(items_to_legacy(items), ensure_ascii=False).encode('utf-8')
+        encoded = encode_content(items)
+        print(f"{name}: JSON {len(legacy)} байт, разбор {measure(lambda: json.loads(legacy), iterations):.1f} мкс; "
+              f"компактный формат {len(encoded)} байт, разбор {measure(lambda: decode_content(encoded), iterations):.1f} мкс")
+        for compression in algorithms:
+            encrypted_legacy = encrypt_data_aes(legacy, compression=compression)
+            encrypted = encrypt_data_aes(encoded, compression=compression)
+            elapsed = measure(lambda: decrypt_content(encrypt_data_aes(encoded, compression=compression)), iterations)
+            print(f"  {compression}: {len(encrypted)} байт (JSON — {len(encrypted_legacy)}), "
+                  f"{elapsed:.0f} мкс на шифрование и дешифрование")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--capsules", type=int, default=20, help="капсул на пользователя")
+    parser.add_argument("--recipients", type=int, default=5, help="получателей на капсулу")
+    parser.add_argument("--iterations", type=int, default=500)
+    parser.add_argument("--crypto", action="store_true", help="только сжатие и шифрование содержимого")
+    args = parser.parse_args()
+    if args.crypto:
+        run_crypto(args.iterations)
+    else:
+        asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()
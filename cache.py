@@ -0,0 +1,145 @@
+import asyncio
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+import redis.asyncio as aioredis
+from config import logger
+
+class TTLCache:
+    """Ограниченный по размеру LRU-кэш с временем жизни записей."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Получение значения, если оно есть и не устарело."""
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        value, expires_at = entry
+        if expires_at < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        """Сохранение значения с вытеснением самых старых записей."""
+        self._data[key] = (value, time.monotonic() + self.ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable) -> Any:
+        """Удаление записи с возвратом её значения без учёта в статистике."""
+        entry = self._data.pop(key, None)
+        return entry[0] if entry else None
+
+    def invalidate(self, key: Optional[Hashable] = None):
+        """Удаление одной записи или очистка всего кэша."""
+        if key is None:
+            self._data.clear()
+        else:
+            self._data.pop(key, None)
+
+    def stats(self) -> dict:
+        """Счётчики попаданий и промахов кэша."""
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0
+        }
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+class RedisCache:
+    """Общий для всех процессов бота кэш JSON-значений в Redis.
+
+    Ошибки Redis не прерывают работу: чтение считается промахом, запись пропускается.
+    """
+
+    def __init__(self, url: str, ttl: int, prefix: str = "cache:"):
+        self.url = url
+        self.ttl = ttl
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+        self._client: Optional[aioredis.Redis] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _get_client(self) -> aioredis.Redis:
+        """Клиент Redis, привязанный к текущему циклу событий."""
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._loop is not loop:
+            self._client = aioredis.from_url(self.url)
+            self._loop = loop
+        return self._client
+
+    async def get(self, key: str) -> Any:
+        """Получение значения; None при отсутствии или ошибке Redis."""
+        try:
+            raw = await self._get_client().get(self.prefix + key)
+        except Exception as e:
+            logger.warning(f"Ошибка чтения кэша Redis {key}: {e}")
+            raw = None
+        if raw is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(raw)
+
+    async def set(self, key: str, value: Any):
+        """Сохранение значения с временем жизни."""
+        try:
+            await self._get_client().set(self.prefix + key, json.dumps(value, ensure_ascii=False), ex=self.ttl)
+        except Exception as e:
+            logger.warning(f"Ошибка записи кэша Redis {key}: {e}")
+
+    async def delete(self, *keys: str):
+        """Удаление значений."""
+        try:
+            await self._get_client().delete(*(self.prefix + key for key in keys))
+        except Exception as e:
+            logger.warning(f"Ошибка удаления из кэша Redis: {e}")
+
+    async def version(self, name: str) -> Optional[int]:
+        """Текущая версия группы ключей; None, если Redis недоступен."""
+        try:
+            return int(await self._get_client().get(f"{self.prefix}version:{name}") or 0)
+        except Exception as e:
+            logger.warning(f"Ошибка чтения версии кэша Redis {name}: {e}")
+            return None
+
+    async def bump(self, name: str):
+        """Увеличение версии: все ключи группы со старой версией перестают читаться."""
+        try:
+            await self._get_client().incr(f"{self.prefix}version:{name}")
+        except Exception as e:
+            logger.warning(f"Ошибка обновления версии кэша Redis {name}: {e}")
+
+    def stats(self) -> dict:
+        """Счётчики попаданий и промахов кэша."""
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0
+        }
+
+    async def close(self):
+        """Закрытие соединений с Redis."""
+        if self._client is not None and self._loop is asyncio.get_running_loop():
+            await self._client.aclose()
+        self._client = None
+        self._loop = None
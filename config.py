@@ -3,7 +3,6 @@ import sys
 import logging
 import redis
 from dotenv import load_dotenv
-from supabase import create_client
 from celery import Celery
 
 # Настройка логирования
@@ -19,18 +18,73 @@ SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 REDIS_URL = os.getenv("REDIS_URL")
 
-if not all([TELEGRAM_TOKEN, ENCRYPTION_KEY, SUPABASE_URL, SUPABASE_KEY, REDIS_URL]):
+# Хранилище данных: supabase (по умолчанию) или sqlite для локального запуска и нагрузочных тестов
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "supabase").lower()
+SQLITE_PATH = os.getenv("SQLITE_PATH", ":memory:")
+
+required = [TELEGRAM_TOKEN, ENCRYPTION_KEY, REDIS_URL]
+if STORAGE_BACKEND == "supabase":
+    required += [SUPABASE_URL, SUPABASE_KEY]
+if not all(required):
     logger.error("Не все обязательные переменные окружения заданы")
     sys.exit(1)
 
-ENCRYPTION_KEY_BYTES = ENCRYPTION_KEY.encode('utf-8').ljust(32)[:32]
-
-# Инициализация Supabase
-try:
-    supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
-except Exception as e:
-    logger.error("Ошибка инициализации Supabase: %s", e)
+# Ключи шифрования по id: текущий (ENCRYPTION_KEY) и прежние для чтения старых записей
+# (OLD_ENCRYPTION_KEYS="1:секрет,2:секрет"). Сами ключи выводятся из секретов через HKDF.
+ENCRYPTION_KEY_ID = int(os.getenv("ENCRYPTION_KEY_ID", "1"))
+ENCRYPTION_KEYS = {ENCRYPTION_KEY_ID: ENCRYPTION_KEY}
+for entry in filter(None, os.getenv("OLD_ENCRYPTION_KEYS", "").split(",")):
+    key_id, _, secret = entry.strip().partition(":")
+    ENCRYPTION_KEYS.setdefault(int(key_id), secret)
+if not all(0 < key_id < 256 and secret for key_id, secret in ENCRYPTION_KEYS.items()):
+    logger.error("Идентификаторы ключей шифрования должны быть от 1 до 255, секреты — непустыми")
     sys.exit(1)
+# Ключ записей старых форматов (без id ключа): исходный секрет с id 1, дополненный до 32 байт
+ENCRYPTION_KEY_BYTES = ENCRYPTION_KEYS.get(1, ENCRYPTION_KEY).encode('utf-8').ljust(32)[:32]
+# Сжатие содержимого перед шифрованием: zlib, zstd (если установлен zstandard) или none
+CONTENT_COMPRESSION = os.getenv("CONTENT_COMPRESSION", "zlib").lower()
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "256"))
+# Пулы для шифрования и разбора содержимого вне цикла событий
+CRYPTO_THREADS = int(os.getenv("CRYPTO_THREADS", "4"))
+CRYPTO_PROCESSES = int(os.getenv("CRYPTO_PROCESSES", "2"))
+CRYPTO_PROCESS_THRESHOLD = int(os.getenv("CRYPTO_PROCESS_THRESHOLD", str(1024 * 1024)))
+
+# Настройки доступа к Supabase (PostgREST)
+SUPABASE_REST_URL = f"{SUPABASE_URL.rstrip('/')}/rest/v1" if SUPABASE_URL else None
+SUPABASE_HEADERS = {
+    "apikey": SUPABASE_KEY,
+    "Authorization": f"Bearer {SUPABASE_KEY}",
+    "Content-Type": "application/json"
+}
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))
+DB_KEEPALIVE_TIMEOUT = float(os.getenv("DB_KEEPALIVE_TIMEOUT", "30"))
+DB_TIMEOUT = float(os.getenv("DB_TIMEOUT", "10"))
+BOT_POOL_SIZE = int(os.getenv("BOT_POOL_SIZE", "32"))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "300"))
+CAPSULE_CACHE_ENABLED = os.getenv("CAPSULE_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+CAPSULE_CACHE_TTL = int(os.getenv("CAPSULE_CACHE_TTL", "600"))
+
+# Лимиты отправки сообщений Telegram
+GLOBAL_SEND_RATE = float(os.getenv("GLOBAL_SEND_RATE", "25"))
+CHAT_SEND_RATE = float(os.getenv("CHAT_SEND_RATE", "1"))
+CHAT_SEND_BURST = float(os.getenv("CHAT_SEND_BURST", "5"))
+DELIVERY_CONCURRENCY = int(os.getenv("DELIVERY_CONCURRENCY", "50"))
+COALESCE_TEXT = os.getenv("COALESCE_TEXT", "false").lower() in ("1", "true", "yes")
+DELIVERY_LEDGER_TTL = int(os.getenv("DELIVERY_LEDGER_TTL", str(7 * 24 * 3600)))
+DELIVERY_MAX_RETRIES = int(os.getenv("DELIVERY_MAX_RETRIES", "8"))
+DELIVERY_RETRY_BACKOFF = int(os.getenv("DELIVERY_RETRY_BACKOFF", "30"))
+
+# Планировщик отправки капсул
+SWEEP_INTERVAL = float(os.getenv("SWEEP_INTERVAL", "30"))
+SWEEP_BATCH_SIZE = int(os.getenv("SWEEP_BATCH_SIZE", "100"))
+SWEEP_MAX_BATCHES = int(os.getenv("SWEEP_MAX_BATCHES", "20"))
+DISPATCH_LEASE_SECONDS = int(os.getenv("DISPATCH_LEASE_SECONDS", "600"))
+
+# Перешифрование содержимого капсул новым ключом
+REENCRYPT_BATCH_SIZE = int(os.getenv("REENCRYPT_BATCH_SIZE", "200"))
+REENCRYPT_MAX_BATCHES = int(os.getenv("REENCRYPT_MAX_BATCHES", "50"))
+REENCRYPT_LOCK_SECONDS = int(os.getenv("REENCRYPT_LOCK_SECONDS", "300"))
 
 # Настройка Celery
 celery_app = Celery('tasks', broker=REDIS_URL)
@@ -39,7 +93,14 @@ celery_app.conf.update(
     result_serializer='json',
     accept_content=['json'],
     timezone='UTC',
-    broker_connection_retry_on_startup=True
+    broker_connection_retry_on_startup=True,
+    beat_schedule={
+        'dispatch-due-capsules': {
+            'task': 'main.dispatch_due_capsules',
+            'schedule': SWEEP_INTERVAL,
+            'options': {'expires': SWEEP_INTERVAL}
+        }
+    }
 )
 
 # Проверка подключения к Redis
@@ -0,0 +1,92 @@
+import json
+import struct
+from itertools import accumulate
+from typing import Dict, List, Tuple, Union
+
+# Содержимое капсулы — список элементов (тип, значение) в порядке добавления:
+# значение — текст сообщения или file_id вложения.
+ContentItem = Tuple[str, str]
+
+# Порядок типов в старом формате (словарь списков по типам)
+CONTENT_ORDER = ['text', 'stickers', 'photos', 'documents', 'voices', 'videos', 'audios']
+
+# Компактный формат: заголовок (версия, число элементов), коды типов по одному
+# байту на элемент и значения в UTF-8, разделённые нулевым символом, — при
+# разборе они декодируются и делятся одним вызовом. Если нулевой символ есть
+# в самом значении, вместо разделителей записываются длины значений в символах.
+FORMAT_SEPARATED = 0x02
+FORMAT_LENGTHS = 0x03
+HEADER = struct.Struct('<BI')
+SEPARATOR = '\x00'
+TYPE_CODES = {
+    'text': 1,
+    'photos': 2,
+    'videos': 3,
+    'audios': 4,
+    'documents': 5,
+    'stickers': 6,
+    'voices': 7
+}
+TYPE_NAMES = {code: kind for kind, code in TYPE_CODES.items()}
+
+def items_from_legacy(content: Dict[str, List[str]]) -> List[ContentItem]:
+    """Преобразование словаря списков по типам в список элементов."""
+    return [(kind, value) for kind in CONTENT_ORDER for value in content.get(kind, [])]
+
+def items_to_legacy(items: List[ContentItem]) -> Dict[str, List[str]]:
+    """Преобразование списка элементов в словарь списков по типам."""
+    content = {kind: [] for kind in CONTENT_ORDER}
+    for kind, value in items:
+        content[kind].append(value)
+    return content
+
+def to_items(content: Union[list, dict, str, bytes]) -> List[ContentItem]:
+    """Приведение содержимого любого формата к списку элементов."""
+    if isinstance(content, (str, bytes)):
+        return decode_content(content)
+    if isinstance(content, dict):
+        return items_from_legacy(content)
+    return [(kind, value) for kind, value in content]
+
+def add_item(content: Union[list, dict, None], kind: str, value: str) -> List[list]:
+    """Добавление элемента в конец содержимого, которое собирает пользователь."""
+    items = [list(item) for item in to_items(content or [])]
+    items.append([kind, value])
+    return items
+
+def count_items(items: List[ContentItem]) -> Dict[str, int]:
+    """Количество элементов каждого типа."""
+    counts = {}
+    for kind, _ in items:
+        counts[kind] = counts.get(kind, 0) + 1
+    return counts
+
+def encode_content(content: Union[list, dict, str, bytes]) -> bytes:
+    """Кодирование содержимого в компактный двоичный формат."""
+    items = to_items(content)
+    kinds = bytes(TYPE_CODES[kind] for kind, _ in items)
+    values = [value for _, value in items]
+    joined = SEPARATOR.join(values)
+    if joined.count(SEPARATOR) == max(len(values) - 1, 0):
+        return HEADER.pack(FORMAT_SEPARATED, len(items)) + kinds + joined.encode('utf-8')
+    lengths = struct.pack(f'<{len(values)}I', *map(len, values))
+    return HEADER.pack(FORMAT_LENGTHS, len(items)) + kinds + lengths + ''.join(values).encode('utf-8')
+
+def decode_content(data: Union[bytes, str]) -> List[ContentItem]:
+    """Разбор содержимого: компактный формат или старый JSON-словарь."""
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    if data[:1] == b'{':
+        return items_from_legacy(json.loads(data))
+    version, count = HEADER.unpack_from(data)
+    start = HEADER.size + count
+    kinds = map(TYPE_NAMES.__getitem__, data[HEADER.size:start])
+    if version == FORMAT_SEPARATED:
+        values = str(memoryview(data)[start:], 'utf-8').split(SEPARATOR) if count else []
+    elif version == FORMAT_LENGTHS:
+        lengths = struct.unpack_from(f'<{count}I', data, start)
+        text = str(memoryview(data)[start + 4 * count:], 'utf-8')
+        values = [text[end - length:end] for length, end in zip(lengths, accumulate(lengths))]
+    else:
+        raise ValueError(f"Неизвестная версия формата содержимого: {version}")
+    return list(zip(kinds, values))
@@ -1,26 +1,248 @@
 import os
+import base64
+import zlib
+import asyncio
+import hashlib
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional, Union
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from cryptography.hazmat.primitives import padding
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives import padding, hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.backends import default_backend
-from config import ENCRYPTION_KEY_BYTES
-
-def encrypt_data_aes(data: str) -> str:
-    """Шифрование данных с помощью AES."""
-    iv = os.urandom(16)
-    cipher = Cipher(algorithms.AES(ENCRYPTION_KEY_BYTES), modes.CBC(iv), backend=default_backend())
-    padder = padding.PKCS7(128).padder()
-    padded_data = padder.update(data.encode('utf-8')) + padder.finalize()
-    encryptor = cipher.encryptor()
-    encrypted = encryptor.update(padded_data) + encryptor.finalize()
-    return (iv + encrypted).hex()
-
-def decrypt_data_aes(encrypted_hex: str, key: bytes) -> str:
-    """Дешифрование данных с помощью AES."""
+from config import (
+    logger, ENCRYPTION_KEY_BYTES, ENCRYPTION_KEYS, ENCRYPTION_KEY_ID, CONTENT_COMPRESSION, COMPRESSION_MIN_SIZE,
+    CRYPTO_THREADS, CRYPTO_PROCESSES, CRYPTO_PROCESS_THRESHOLD
+)
+from content import ContentItem, decode_content, to_items
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Формат v3: base64(версия | флаги | id ключа | nonce | шифротекст AES-GCM с тегом).
+# Заголовок аутентифицируется как associated data, флаги указывают, каким
+# алгоритмом данные сжаты перед шифрованием. Формат v2 — тот же конверт без id
+# ключа, зашифрованный ключом ENCRYPTION_KEY_BYTES; v1 — hex(iv | AES-CBC).
+ENVELOPE_VERSION = 3
+ENVELOPE_V2 = 2
+HEADER_SIZES = {ENVELOPE_V2: 2, ENVELOPE_VERSION: 3}
+NONCE_SIZE = 12
+KDF_SALT = b"time-capsule/content"
+LEGACY_HEX_DIGITS = "0123456789abcdef"
+FLAG_ZLIB = 0x01
+FLAG_ZSTD = 0x02
+COMPRESSION_FLAGS = {"zlib": FLAG_ZLIB, "zstd": FLAG_ZSTD}
+
+if CONTENT_COMPRESSION == "zstd" and zstandard is None:
+    logger.warning("Пакет zstandard не установлен, для сжатия содержимого используется zlib")
+    CONTENT_COMPRESSION = "zlib"
+
+def compress(data: bytes, compression: str = CONTENT_COMPRESSION) -> tuple:
+    """Сжатие данных; возвращает (данные, флаг). Маленькие и несжимаемые данные не сжимаются."""
+    flag = COMPRESSION_FLAGS.get(compression, 0)
+    if not flag or len(data) < COMPRESSION_MIN_SIZE:
+        return data, 0
+    if flag == FLAG_ZSTD:
+        compressed = zstandard.ZstdCompressor(level=3).compress(data)
+    else:
+        compressed = zlib.compress(data, 6)
+    return (compressed, flag) if len(compressed) < len(data) else (data, 0)
+
+def decompress(data: bytes, flags: int) -> bytes:
+    """Распаковка данных по флагам заголовка."""
+    if flags & FLAG_ZSTD:
+        if zstandard is None:
+            raise RuntimeError("Для чтения содержимого нужен пакет zstandard")
+        return zstandard.ZstdDecompressor().decompress(data)
+    if flags & FLAG_ZLIB:
+        return zlib.decompress(data)
+    return data
+
+class KeyRegistry:
+    """Ключи шифрования по id, выведенные из секретов через HKDF-SHA256."""
+
+    def __init__(self, secrets: Dict[int, str], current_id: int, legacy_key: bytes):
+        self.secrets = secrets
+        self.current_id = current_id
+        self.legacy_key = legacy_key
+        self._aead: Dict[int, AESGCM] = {}
+
+    def derive(self, key_id: int) -> bytes:
+        """Вывод 256-битного ключа из секрета с данным id."""
+        if key_id not in self.secrets:
+            raise KeyError(f"Ключ шифрования с id {key_id} не задан")
+        return HKDF(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=KDF_SALT,
+            info=f"content-key:{key_id}".encode('ascii')
+        ).derive(self.secrets[key_id].encode('utf-8'))
+
+    def aead(self, key_id: int) -> AESGCM:
+        """Подготовленный объект AES-GCM для ключа; создаётся один раз."""
+        if key_id not in self._aead:
+            self._aead[key_id] = AESGCM(self.derive(key_id))
+        return self._aead[key_id]
+
+keys = KeyRegistry(ENCRYPTION_KEYS, ENCRYPTION_KEY_ID, ENCRYPTION_KEY_BYTES)
+
+@lru_cache(maxsize=8)
+def _aesgcm(key: bytes) -> AESGCM:
+    """Подготовленный объект AES-GCM для ключа старого формата v2."""
+    return AESGCM(key)
+
+@lru_cache(maxsize=8)
+def _aes(key: bytes) -> algorithms.AES:
+    """Подготовленный алгоритм AES для старого формата CBC."""
+    return algorithms.AES(key)
+
+def encrypt_data_aes(data: Union[str, bytes], key_id: Optional[int] = None, compression: str = CONTENT_COMPRESSION) -> str:
+    """Сжатие и шифрование строки или байтов с помощью AES-GCM в конверт формата v3."""
+    key_id = keys.current_id if key_id is None else key_id
+    payload, flags = compress(data.encode('utf-8') if isinstance(data, str) else data, compression)
+    header = bytes([ENVELOPE_VERSION, flags, key_id])
+    nonce = os.urandom(NONCE_SIZE)
+    encrypted = keys.aead(key_id).encrypt(nonce, payload, header)
+    return base64.b64encode(header + nonce + encrypted).decode('ascii')
+
+def _decrypt_legacy_cbc(encrypted_hex: str, key: bytes) -> bytes:
+    """Дешифрование старого формата: hex(iv | AES-CBC с PKCS7)."""
     data = bytes.fromhex(encrypted_hex)
     iv, encrypted = data[:16], data[16:]
-    cipher = Cipher(algorithms.AES(key), modes.CBC(iv), backend=default_backend())
+    cipher = Cipher(_aes(key), modes.CBC(iv), backend=default_backend())
     decryptor = cipher.decryptor()
     decrypted = decryptor.update(encrypted) + decryptor.finalize()
     unpadder = padding.PKCS7(128).unpadder()
-    unpadded = unpadder.update(decrypted) + unpadder.finalize()
-    return unpadded.decode('utf-8')
+    return unpadder.update(decrypted) + unpadder.finalize()
+
+def envelope_key_id(encrypted: str) -> Optional[int]:
+    """Id ключа, которым зашифрованы данные; None для старых форматов без id."""
+    if encrypted[:1] in LEGACY_HEX_DIGITS:
+        return None
+    header = base64.b64decode(encrypted[:4])
+    return header[2] if header[0] == ENVELOPE_VERSION else None
+
+def needs_reencryption(encrypted: str) -> bool:
+    """Зашифрованы ли данные не текущим ключом или в старом формате."""
+    return envelope_key_id(encrypted) != keys.current_id
+
+def decrypt_bytes(encrypted: str, key: Optional[bytes] = None) -> bytes:
+    """Дешифрование данных: конверт v3 или v2, либо старый hex-формат AES-CBC.
+
+    key — ключ для старых форматов, по умолчанию ENCRYPTION_KEY_BYTES.
+    """
+    legacy_key = key or keys.legacy_key
+    if encrypted[:1] in LEGACY_HEX_DIGITS:
+        return _decrypt_legacy_cbc(encrypted, legacy_key)
+    data = base64.b64decode(encrypted)
+    header_size = HEADER_SIZES.get(data[0])
+    if header_size is None:
+        raise ValueError(f"Неизвестная версия формата шифрования: {data[0]}")
+    header = data[:header_size]
+    nonce, ciphertext = data[header_size:header_size + NONCE_SIZE], data[header_size + NONCE_SIZE:]
+    aead = keys.aead(header[2]) if data[0] == ENVELOPE_VERSION else _aesgcm(legacy_key)
+    return decompress(aead.decrypt(nonce, ciphertext, header), header[1])
+
+def decrypt_data_aes(encrypted: str, key: Optional[bytes] = None) -> str:
+    """Дешифрование строки."""
+    return decrypt_bytes(encrypted, key).decode('utf-8')
+
+def reencrypt(encrypted: str) -> str:
+    """Перешифрование данных текущим ключом без изменения содержимого."""
+    return encrypt_data_aes(decrypt_bytes(encrypted))
+
+# Содержимое меньше этого размера обрабатывается сразу: передача в пул дороже самой работы
+INLINE_MAX_SIZE = 4096
+
+_pools: Dict[str, Optional[Executor]] = {}
+_pools_pid: Optional[int] = None
+# Задачи, отправленные в пул и ещё не завершённые
+_pending = {"thread": 0, "process": 0}
+
+def _get_pool(kind: str) -> Optional[Executor]:
+    """Пул потоков или процессов текущего процесса; None, если пул процессов недоступен."""
+    global _pools_pid
+    if _pools_pid != os.getpid():
+        _pools.clear()
+        _pending.update(thread=0, process=0)
+        _pools_pid = os.getpid()
+    if kind not in _pools:
+        if kind == "process":
+            _pools[kind] = ProcessPoolExecutor(max_workers=CRYPTO_PROCESSES) if CRYPTO_PROCESSES > 0 else None
+        else:
+            _pools[kind] = ThreadPoolExecutor(max_workers=CRYPTO_THREADS, thread_name_prefix="crypto")
+    return _pools[kind]
+
+async def offload(func: Callable, *args, size: int = 0) -> Any:
+    """Выполнение тяжёлой функции вне цикла событий.
+
+    Небольшие данные обрабатываются сразу, крупнее CRYPTO_PROCESS_THRESHOLD —
+    в пуле процессов (если он доступен), остальные — в пуле потоков.
+    """
+    if size < INLINE_MAX_SIZE:
+        return func(*args)
+    loop = asyncio.get_running_loop()
+    kind = "process" if size >= CRYPTO_PROCESS_THRESHOLD and _get_pool("process") else "thread"
+    try:
+        future = loop.run_in_executor(_get_pool(kind), func, *args)
+    except (AssertionError, OSError) as e:
+        # Например, в демонических процессах Celery нельзя запускать дочерние процессы
+        logger.warning(f"Пул процессов для шифрования недоступен, используется пул потоков: {e}")
+        _pools["process"].shutdown(wait=False)
+        _pools["process"] = None
+        kind = "thread"
+        future = loop.run_in_executor(_get_pool(kind), func, *args)
+    _pending[kind] += 1
+    try:
+        return await future
+    finally:
+        _pending[kind] -= 1
+
+def get_pool_stats() -> dict:
+    """Глубина очереди пулов: сколько задач ожидает или выполняется."""
+    return dict(_pending)
+
+def shutdown_pools():
+    """Остановка пулов шифрования."""
+    for pool in _pools.values():
+        if pool:
+            pool.shutdown(wait=False, cancel_futures=True)
+    _pools.clear()
+
+def content_size(content) -> int:
+    """Грубая оценка размера содержимого капсулы без сериализации."""
+    if isinstance(content, (str, bytes)):
+        return len(content)
+    return sum(len(value) for _, value in to_items(content))
+
+def decrypt_content(encrypted: str) -> List[ContentItem]:
+    """Дешифрование и разбор содержимого капсулы в список элементов по порядку добавления."""
+    return decode_content(decrypt_bytes(encrypted))
+
+def reencrypt_batch(rows: List[dict]) -> List[dict]:
+    """Перешифрование пачки строк {capsule_id, content}, зашифрованных не текущим ключом.
+
+    Возвращает строки с новым содержимым и md5 прежнего для проверки при записи.
+    """
+    updates = []
+    for row in rows:
+        if not needs_reencryption(row['content']):
+            continue
+        try:
+            content = reencrypt(row['content'])
+        except Exception as e:
+            logger.error(f"Не удалось перешифровать капсулу {row['capsule_id']}: {e}")
+            continue
+        updates.append({
+            "capsule_id": row['capsule_id'],
+            "old_hash": hashlib.md5(row['content'].encode('utf-8')).hexdigest(),
+            "content": content
+        })
+    return updates
+
+async def decrypt_content_async(encrypted: str) -> List[ContentItem]:
+    """Дешифрование и разбор содержимого капсулы вне цикла событий."""
+    return await offload(decrypt_content, encrypted, size=len(encrypted))
@@ -1,122 +1,524 @@
-from typing import Optional, List
-from config import supabase, logger
-from datetime import datetime
+import asyncio
+from collections import Counter
+from contextvars import ContextVar
+from typing import Optional, List, Dict, Tuple
+from config import (
+    logger, USER_CACHE_SIZE, USER_CACHE_TTL, REDIS_URL, CAPSULE_CACHE_ENABLED, CAPSULE_CACHE_TTL
+)
+from cache import TTLCache, RedisCache
+from storage import StorageBackend, MissingFunctionError, create_backend, FILTER_OPERATORS
+from datetime import datetime, timedelta, timezone
 
-def fetch_data(table: str, query: dict = {}) -> list:
-    """Получение данных из Supabase."""
+_backend: Optional[StorageBackend] = None
+# Число запросов к хранилищу: (операция, таблица) -> количество
+_query_counts: Counter = Counter()
+_users_by_telegram_id = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+_users_by_username = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+# Общий для всех процессов бота кэш списков и метаданных капсул
+_capsule_cache = RedisCache(REDIS_URL, CAPSULE_CACHE_TTL, prefix="capsules:") if CAPSULE_CACHE_ENABLED else None
+
+# Метаданные капсулы без содержимого: читаются одним набором столбцов,
+# чтобы повторные чтения в рамках одного апдейта брались из identity map
+USER_COLUMNS = "id,telegram_id,username,chat_id"
+CAPSULE_META_COLUMNS = "id,creator_id,title,user_capsule_number,scheduled_at,is_sent,content_manifest"
+
+# Результаты чтений в рамках одного апдейта: ключ запроса -> (столбцы, строки)
+_identity_map: ContextVar[Optional[dict]] = ContextVar("identity_map", default=None)
+
+def begin_unit_of_work():
+    """Начало нового контекста запроса с пустой identity map."""
+    _identity_map.set({})
+
+def _invalidate(table: str):
+    """Сброс запомненных чтений таблицы после записи в неё."""
+    identity_map = _identity_map.get()
+    if identity_map is None:
+        return
+    if table.startswith("rpc/"):
+        identity_map.clear()
+        return
+    for key in [key for key in identity_map if key[0] == table]:
+        del identity_map[key]
+
+def _columns_set(columns: str) -> Optional[frozenset]:
+    """Набор запрошенных столбцов; None означает все столбцы."""
+    if columns == "*":
+        return None
+    return frozenset(column.strip() for column in columns.split(","))
+
+def get_backend() -> StorageBackend:
+    """Получение хранилища, выбранного в настройках."""
+    global _backend
+    if _backend is None:
+        _backend = create_backend()
+    return _backend
+
+def get_query_stats() -> dict:
+    """Число запросов к хранилищу по операциям и таблицам."""
+    return {f"{operation} {table}": count for (operation, table), count in _query_counts.items()}
+
+def reset_query_stats():
+    """Обнуление счётчиков запросов к хранилищу."""
+    _query_counts.clear()
+
+def _track(operation: str, table: str):
+    """Учёт запроса к хранилищу."""
+    _query_counts[(operation, table)] += 1
+
+async def close_session():
+    """Закрытие соединений с хранилищем и клиента кэша капсул."""
+    if _backend is not None:
+        await _backend.close()
+    if _capsule_cache:
+        await _capsule_cache.close()
+
+def _user_version_key(creator_id: int) -> str:
+    """Имя версии кэша капсул пользователя."""
+    return f"user:{creator_id}"
+
+async def _invalidate_capsule_cache(table: str, rows: list):
+    """Сброс кэша капсул после записи: метаданные по id и версия списков владельца."""
+    if not _capsule_cache or table != "capsules" or not rows:
+        return
+    await _capsule_cache.delete(*(f"meta:{row['id']}" for row in rows if 'id' in row))
+    for creator_id in {row['creator_id'] for row in rows if row.get('creator_id') is not None}:
+        await _capsule_cache.bump(_user_version_key(creator_id))
+
+def _build_filters(query: dict) -> list:
+    """Преобразование словаря условий в список (столбец, оператор, значение).
+
+    Ключ "column" означает равенство (для списка значений — in, для None — is.null),
+    ключ "column__op" — оператор op: neq, gt, gte, lt, lte, in, is, like, ilike.
+    """
+    filters = []
+    for key, value in query.items():
+        column, _, op = key.partition("__")
+        if not op:
+            op = "in" if isinstance(value, (list, tuple, set)) else "is" if value is None else "eq"
+        if op not in FILTER_OPERATORS:
+            raise ValueError(f"Неизвестный оператор фильтра: {op}")
+        filters.append((column, op, tuple(value) if op == "in" else value))
+    return filters
+
+async def fetch_data(
+    table: str,
+    query: dict = {},
+    columns: str = "*",
+    order: Optional[str] = None,
+    limit: Optional[int] = None,
+    offset: Optional[int] = None,
+    raise_errors: bool = False
+) -> list:
+    """Получение данных из хранилища.
+
+    columns — список столбцов через запятую, order — например "id" или "id.desc".
+    Внутри контекста запроса повторное чтение тех же строк берётся из identity map.
+    При raise_errors ошибка хранилища пробрасывается, а не превращается в пустой результат.
+    """
+    filters = _build_filters(query)
+    identity_map = _identity_map.get() if "(" not in columns else None
+    key = (table, tuple(filters), order, limit, offset)
+    wanted = _columns_set(columns)
+    if identity_map is not None and key in identity_map:
+        cached_columns, rows = identity_map[key]
+        if cached_columns is None or (wanted is not None and wanted <= cached_columns):
+            return [dict(row) for row in rows]
+        if wanted is not None:
+            wanted = wanted | cached_columns
+            columns = ",".join(sorted(wanted))
+
+    _track("select", table)
     try:
-        response = supabase.table(table).select("*")
-        for key, value in query.items():
-            response = response.eq(key, value)
-        return response.execute().data
+        rows = await get_backend().select(table, filters, columns, order, limit, offset)
     except Exception as e:
-        logger.error(f"Ошибка Supabase: {e}")
+        logger.error(f"Ошибка чтения из хранилища: {e}")
+        if raise_errors:
+            raise
         return []
+    if identity_map is not None:
+        identity_map[key] = (wanted, rows)
+        return [dict(row) for row in rows]
+    return rows
 
-def post_data(table: str, data: dict) -> list:
-    """Добавление данных в Supabase."""
+async def count_data(table: str, query: dict = {}) -> int:
+    """Точный подсчёт строк без загрузки самих данных."""
+    _track("count", table)
     try:
-        return supabase.table(table).insert(data).execute().data
+        return await get_backend().count(table, _build_filters(query))
     except Exception as e:
-        logger.error(f"Ошибка записи в Supabase: {e}")
+        logger.error(f"Ошибка подсчёта в хранилище: {e}")
+        return 0
+
+async def _write(operation: str, table: str, *args) -> list:
+    """Запись в хранилище со сбросом identity map и кэша капсул."""
+    _track(operation, table)
+    _invalidate(table)
+    rows = await getattr(get_backend(), operation)(table, *args)
+    await _invalidate_capsule_cache(table, rows)
+    return rows
+
+async def post_data(table: str, data: dict) -> list:
+    """Добавление данных в хранилище."""
+    try:
+        return await _write("insert", table, data)
+    except Exception as e:
+        logger.error(f"Ошибка записи в хранилище: {e}")
         return []
 
-def update_data(table: str, query: dict, data: dict) -> list:
-    """Обновление данных в Supabase."""
+async def upsert_data(table: str, data, on_conflict: str, ignore_duplicates: bool = False) -> list:
+    """Вставка или обновление строк по уникальному ключу."""
     try:
-        query_builder = supabase.table(table).update(data)
-        for key, value in query.items():
-            query_builder = query_builder.eq(key, value)
-        return query_builder.execute().data
+        return await _write("upsert", table, data, on_conflict, ignore_duplicates)
     except Exception as e:
-        logger.error(f"Ошибка обновления в Supabase: {e}")
+        logger.error(f"Ошибка записи в хранилище: {e}")
         return []
 
-def delete_data(table: str, query: dict) -> list:
-    """Удаление данных из Supabase."""
+async def update_data(table: str, query: dict, data: dict) -> list:
+    """Обновление данных в хранилище."""
     try:
-        return (
-            supabase.table(table)
-            .delete()
-            .eq(next(iter(query)), query[next(iter(query))])
-            .execute()
-            .data
-        )
+        return await _write("update", table, _build_filters(query), data)
     except Exception as e:
-        logger.error(f"Ошибка удаления в Supabase: {e}")
+        logger.error(f"Ошибка обновления в хранилище: {e}")
         return []
 
-def get_chat_id(username: str) -> Optional[int]:
+async def delete_data(table: str, query: dict) -> list:
+    """Удаление данных из хранилища."""
+    try:
+        return await _write("delete", table, _build_filters(query))
+    except Exception as e:
+        logger.error(f"Ошибка удаления в хранилище: {e}")
+        return []
+
+async def call_rpc(name: str, params: dict, raise_errors: bool = False):
+    """Вызов хранимой функции; возвращает строки или скалярное значение."""
+    _track("rpc", name)
+    _invalidate(f"rpc/{name}")
+    try:
+        return await get_backend().rpc(name, params)
+    except Exception as e:
+        logger.error(f"Ошибка вызова функции {name} в хранилище: {e}")
+        if raise_errors:
+            raise
+        return []
+
+def _cache_user(user: dict):
+    """Сохранение записи пользователя в кэшах по telegram_id и username."""
+    _users_by_telegram_id.set(user['telegram_id'], user)
+    _users_by_username.set(user['username'], user)
+
+def invalidate_user(telegram_id: Optional[int] = None, username: Optional[str] = None):
+    """Удаление записи пользователя из кэшей."""
+    for user in (_users_by_telegram_id.pop(telegram_id), _users_by_username.pop(username)):
+        if user:
+            _users_by_telegram_id.pop(user['telegram_id'])
+            _users_by_username.pop(user['username'])
+
+def get_cache_stats() -> dict:
+    """Статистика кэшей пользователей и капсул."""
+    stats = {
+        "users_by_telegram_id": _users_by_telegram_id.stats(),
+        "users_by_username": _users_by_username.stats()
+    }
+    if _capsule_cache:
+        stats["capsules"] = _capsule_cache.stats()
+    return stats
+
+async def get_user_by_telegram_id(telegram_id: int) -> Optional[dict]:
+    """Получение пользователя по telegram_id с кэшированием."""
+    user = _users_by_telegram_id.get(telegram_id)
+    if user is None:
+        response = await fetch_data("users", {"telegram_id": telegram_id}, columns=USER_COLUMNS)
+        if not response:
+            return None
+        user = response[0]
+        _cache_user(user)
+    return user
+
+async def get_users_by_username(usernames: List[str], raise_errors: bool = False) -> Dict[str, dict]:
+    """Получение пользователей по списку имён одним запросом с кэшированием."""
+    users = {}
+    missing = []
+    for username in dict.fromkeys(usernames):
+        user = _users_by_username.get(username)
+        if user is None:
+            missing.append(username)
+        else:
+            users[username] = user
+    if missing:
+        for user in await fetch_data("users", {"username": missing}, columns=USER_COLUMNS, raise_errors=raise_errors):
+            _cache_user(user)
+            users[user['username']] = user
+    return users
+
+async def get_chat_ids(usernames: List[str], raise_errors: bool = False) -> Dict[str, int]:
+    """Получение chat_id для списка имён пользователей одним запросом."""
+    users = await get_users_by_username(usernames, raise_errors)
+    return {username: user['chat_id'] for username, user in users.items() if user.get('chat_id')}
+
+async def get_chat_id(username: str) -> Optional[int]:
     """Получение chat_id по имени пользователя."""
-    response = fetch_data("users", {"username": username})
-    return response[0]['chat_id'] if response else None
-
-def add_user(username: str, telegram_id: int, chat_id: int):
-    """Добавление пользователя в базу данных."""
-    if not fetch_data("users", {"telegram_id": telegram_id}):
-        post_data("users", {
-            "telegram_id": telegram_id,
-            "username": username,
-            "chat_id": chat_id
-        })
-
-def generate_unique_capsule_number(creator_id: int) -> int:
+    return (await get_chat_ids([username])).get(username)
+
+async def add_user(username: str, telegram_id: int, chat_id: int) -> Optional[dict]:
+    """Добавление пользователя в базу данных; возвращает его запись."""
+    user = await get_user_by_telegram_id(telegram_id)
+    if user:
+        return user
+    invalidate_user(username=username)
+    response = await post_data("users", {
+        "telegram_id": telegram_id,
+        "username": username,
+        "chat_id": chat_id
+    })
+    if not response:
+        return None
+    _cache_user(response[0])
+    return response[0]
+
+async def generate_unique_capsule_number(creator_id: int) -> int:
     """Генерация уникального номера капсулы для пользователя."""
-    return len(fetch_data("capsules", {"creator_id": creator_id})) + 1
+    number = await call_rpc("next_capsule_number", {"p_user_id": creator_id})
+    if isinstance(number, int):
+        return number
+    logger.warning(f"Счётчик капсул пользователя {creator_id} недоступен, номер вычислен подсчётом")
+    return await count_data("capsules", {"creator_id": creator_id}) + 1
+
+def _seal_content(content) -> Tuple[str, dict]:
+    """Кодирование, шифрование и сводка содержимого капсулы за один проход."""
+    from content import to_items, count_items, encode_content
+    from crypto import encrypt_data_aes
+    items = to_items(content)
+    encoded = encode_content(items)
+    return encrypt_data_aes(encoded), {"counts": count_items(items), "total_size": len(encoded)}
+
+async def seal_content(content) -> Tuple[str, dict]:
+    """Шифрование и сводка содержимого (список элементов, словарь или JSON) вне цикла событий."""
+    from crypto import offload, content_size
+    return await offload(_seal_content, content, size=content_size(content))
+
+async def save_content(capsule_id: int, content):
+    """Сохранение зашифрованного содержимого капсулы и обновление сводки."""
+    encrypted, manifest = await seal_content(content)
+    await upsert_data("capsule_contents", {
+        "capsule_id": capsule_id,
+        "content": encrypted
+    }, on_conflict="capsule_id")
+    await update_data("capsules", {"id": capsule_id}, {"content_manifest": manifest})
 
-def create_capsule(
+async def get_capsule_content(capsule_id: int, raise_errors: bool = False) -> Optional[str]:
+    """Получение зашифрованного содержимого капсулы."""
+    response = await fetch_data("capsule_contents", {"capsule_id": capsule_id}, columns="content", raise_errors=raise_errors)
+    if response:
+        return response[0]['content']
+    legacy = await fetch_data("capsules", {"id": capsule_id}, columns="content", raise_errors=raise_errors)
+    return legacy[0]['content'] if legacy and legacy[0]['content'] else None
+
+async def get_capsule_contents_batch(after_id: int, limit: int) -> list:
+    """Очередная пачка зашифрованного содержимого по возрастанию capsule_id; ошибки хранилища пробрасываются."""
+    return await fetch_data(
+        "capsule_contents", {"capsule_id__gt": after_id},
+        columns="capsule_id,content", order="capsule_id", limit=limit, raise_errors=True
+    )
+
+async def rotate_capsule_contents(rows: List[dict]) -> Optional[int]:
+    """Запись перешифрованного содержимого одним запросом.
+
+    Строки, изменённые после чтения, пропускаются. Возвращает число
+    обновлённых строк или None при ошибке.
+    """
+    updated = await call_rpc("rotate_capsule_contents", {"p_rows": rows})
+    return updated if isinstance(updated, int) else None
+
+async def create_capsule(
     creator_id: int,
     title: str,
-    content: str,
+    content,
     user_capsule_number: int,
     scheduled_at: Optional[datetime] = None
 ) -> int:
-    """Создание новой капсулы."""
-    from crypto import encrypt_data_aes
-    encrypted_content = encrypt_data_aes(content)
+    """Создание новой капсулы; content — список элементов (тип, значение) или словарь старого формата."""
+    encrypted, manifest = await seal_content(content)
     data = {
         "creator_id": creator_id,
         "title": title,
-        "content": encrypted_content,
+        "content_manifest": manifest,
         "user_capsule_number": user_capsule_number,
         "is_sent": False
     }
     if scheduled_at:
         data["scheduled_at"] = scheduled_at.isoformat()
-    response = post_data("capsules", data)
-    return response[0]['id'] if response else -1
+    response = await post_data("capsules", data)
+    if not response:
+        return -1
+    capsule_id = response[0]['id']
+    if not await post_data("capsule_contents", {"capsule_id": capsule_id, "content": encrypted}):
+        logger.error(f"Содержимое капсулы {capsule_id} не сохранено, капсула удалена")
+        await delete_data("capsules", {"id": capsule_id})
+        return -1
+    return capsule_id
 
-def add_recipient(capsule_id: int, recipient_username: str):
+async def add_recipients(capsule_id: int, usernames: List[str]) -> list:
+    """Добавление получателей к капсуле одним запросом без дубликатов."""
+    rows = [
+        {"capsule_id": capsule_id, "recipient_username": username}
+        for username in dict.fromkeys(usernames) if username
+    ]
+    if not rows:
+        return []
+    return await upsert_data("recipients", rows, on_conflict="capsule_id,recipient_username", ignore_duplicates=True)
+
+async def add_recipient(capsule_id: int, recipient_username: str):
     """Добавление получателя к капсуле."""
-    post_data("recipients", {
-        "capsule_id": capsule_id,
-        "recipient_username": recipient_username
-    })
+    await add_recipients(capsule_id, [recipient_username])
 
-def delete_capsule(capsule_id: int):
+async def delete_capsule(capsule_id: int):
     """Удаление капсулы и связанных данных."""
-    delete_data("recipients", {"capsule_id": capsule_id})
-    delete_data("capsules", {"id": capsule_id})
+    await delete_data("recipients", {"capsule_id": capsule_id})
+    await delete_data("capsule_contents", {"capsule_id": capsule_id})
+    await delete_data("capsules", {"id": capsule_id})
 
-def edit_capsule(capsule_id: int, title: Optional[str] = None, content: Optional[str] = None, scheduled_at: Optional[datetime] = None):
+async def edit_capsule(capsule_id: int, title: Optional[str] = None, content: Optional[str] = None, scheduled_at: Optional[datetime] = None):
     """Редактирование капсулы."""
-    from crypto import encrypt_data_aes
-    data = {}
     if title:
-        data["title"] = title
+        await update_data("capsules", {"id": capsule_id}, {"title": title})
     if content:
-        data["content"] = encrypt_data_aes(content)
+        await save_content(capsule_id, content)
     if scheduled_at:
-        data["scheduled_at"] = scheduled_at.isoformat()
-        data["is_sent"] = False
-    if data:
-        update_data("capsules", {"id": capsule_id}, data)
+        await reschedule_capsule(capsule_id, scheduled_at)
+
+async def get_user_capsules(telegram_id: int, columns: str = "*") -> list:
+    """Получение списка капсул пользователя, упорядоченного по id."""
+    user = await get_user_by_telegram_id(telegram_id)
+    return await fetch_data("capsules", {"creator_id": user['id']}, columns=columns, order="id") if user else []
 
-def get_user_capsules(telegram_id: int) -> list:
-    """Получение списка капсул пользователя."""
-    user = fetch_data("users", {"telegram_id": telegram_id})
-    return fetch_data("capsules", {"creator_id": user[0]['id']}) if user else []
+async def get_user_capsules_page(
+    telegram_id: int,
+    per_page: int,
+    after_id: Optional[int] = None,
+    before_id: Optional[int] = None,
+    columns: str = "id,title"
+) -> Tuple[list, int]:
+    """Получение одной страницы капсул пользователя по курсору (id) и их общего числа."""
+    user = await get_user_by_telegram_id(telegram_id)
+    if not user:
+        return [], 0
+    cache_key = None
+    if _capsule_cache:
+        version = await _capsule_cache.version(_user_version_key(user['id']))
+        if version is not None:
+            cache_key = f"page:{user['id']}:{version}:{columns}:{per_page}:{after_id}:{before_id}"
+            cached = await _capsule_cache.get(cache_key)
+            if cached is not None:
+                return cached[0], cached[1]
+    query = {"creator_id": user['id']}
+    if before_id is not None:
+        page_query = {**query, "id__lt": before_id}
+        order = "id.desc"
+    else:
+        page_query = {**query, "id__gt": after_id} if after_id is not None else query
+        order = "id"
+    capsules, total = await asyncio.gather(
+        fetch_data("capsules", page_query, columns=columns, order=order, limit=per_page),
+        count_data("capsules", query)
+    )
+    if before_id is not None:
+        capsules.reverse()
+    if cache_key:
+        await _capsule_cache.set(cache_key, [capsules, total])
+    return capsules, total
 
-def get_capsule_recipients(capsule_id: int) -> list:
+async def get_capsule_meta(capsule_id: int) -> Optional[dict]:
+    """Получение метаданных капсулы (без содержимого) с общим кэшем в Redis."""
+    if _capsule_cache:
+        cached = await _capsule_cache.get(f"meta:{capsule_id}")
+        if cached is not None:
+            return cached
+    response = await fetch_data("capsules", {"id": capsule_id}, columns=CAPSULE_META_COLUMNS)
+    if not response:
+        return None
+    if _capsule_cache:
+        await _capsule_cache.set(f"meta:{capsule_id}", response[0])
+    return response[0]
+
+async def get_capsule_recipients(capsule_id: int, raise_errors: bool = False) -> list:
     """Получение списка получателей капсулы."""
-    return fetch_data("recipients", {"capsule_id": capsule_id})
+    return await fetch_data("recipients", {"capsule_id": capsule_id}, columns="recipient_username", raise_errors=raise_errors)
+
+async def _collect_delivery_bundle(capsule_id: int) -> Optional[dict]:
+    """Сборка данных для отправки капсулы отдельными запросами; ошибки хранилища пробрасываются."""
+    capsule = await fetch_data(
+        "capsules", {"id": capsule_id}, columns="id,creator_id,is_sent,schedule_version", raise_errors=True
+    )
+    if not capsule:
+        return None
+    capsule = capsule[0]
+    content, recipients, creator = await asyncio.gather(
+        get_capsule_content(capsule_id, raise_errors=True),
+        get_capsule_recipients(capsule_id, raise_errors=True),
+        fetch_data("users", {"id": capsule['creator_id']}, columns="username", raise_errors=True)
+    )
+    usernames = [recipient['recipient_username'] for recipient in recipients]
+    chat_ids = await get_chat_ids(usernames, raise_errors=True)
+    return {
+        **capsule,
+        "sender_username": creator[0]['username'] if creator else None,
+        "content": content,
+        "recipients": [{"username": username, "chat_id": chat_ids.get(username)} for username in usernames]
+    }
+
+async def get_delivery_bundle(capsule_id: int) -> Optional[dict]:
+    """Получение капсулы, её содержимого, отправителя и chat_id получателей одним запросом.
+
+    Возвращает словарь с ключами id, creator_id, is_sent, schedule_version,
+    sender_username, content и recipients (список {username, chat_id}) или None,
+    если капсулы нет. Ошибки хранилища пробрасываются, чтобы их не приняли за отсутствие капсулы.
+    """
+    try:
+        return await call_rpc("get_delivery_bundle", {"p_capsule_id": capsule_id}, raise_errors=True)
+    except MissingFunctionError:
+        logger.warning(f"Функция get_delivery_bundle недоступна, капсула {capsule_id} собирается отдельными запросами")
+        return await _collect_delivery_bundle(capsule_id)
+
+async def claim_due_capsules(limit: int, lease_seconds: int) -> List[dict]:
+    """Захват пачки капсул, время отправки которых наступило."""
+    return await call_rpc("claim_due_capsules", {"p_limit": limit, "p_lease_seconds": lease_seconds})
+
+async def reschedule_capsule(capsule_id: int, scheduled_at: datetime) -> Optional[dict]:
+    """Смена даты отправки капсулы с увеличением версии расписания."""
+    capsule = await get_capsule_meta(capsule_id) if _capsule_cache else None
+    response = await call_rpc("reschedule_capsule", {
+        "p_capsule_id": capsule_id,
+        "p_scheduled_at": scheduled_at.isoformat()
+    })
+    if capsule:
+        await _invalidate_capsule_cache("capsules", [capsule])
+    return response[0] if response else None
+
+async def extend_dispatch_lease(capsule_id: int, lease_seconds: int, schedule_version: Optional[int] = None):
+    """Продление аренды капсулы, пока задача её отправляет или ждёт повторной попытки.
+
+    Если передана версия расписания, аренда капсулы, перенесённой на другую дату, не продлевается.
+    """
+    lease_until = datetime.now(timezone.utc) + timedelta(seconds=lease_seconds)
+    query = {"id": capsule_id, "is_sent": False}
+    if schedule_version is not None:
+        query["schedule_version"] = schedule_version
+    await update_data("capsules", query, {"dispatch_lease_until": lease_until.isoformat()})
+
+async def unschedule_capsule(capsule_id: int, schedule_version: Optional[int] = None):
+    """Снятие капсулы с расписания, чтобы планировщик больше её не забирал.
+
+    Если передана версия расписания, капсула, перенесённая после этого на другую дату, не затрагивается.
+    """
+    query = {"id": capsule_id}
+    if schedule_version is not None:
+        query["schedule_version"] = schedule_version
+    await update_data("capsules", query, {"scheduled_at": None, "dispatch_lease_until": None, "dispatch_task_id": None})
+
+async def get_capsule_schedule(capsule_id: int) -> Optional[dict]:
+    """Получение статуса, даты, аренды и версии расписания капсулы без её содержимого; ошибки хранилища пробрасываются."""
+    response = await fetch_data(
+        "capsules", {"id": capsule_id},
+        columns="id,is_sent,schedule_version,scheduled_at,dispatch_lease_until", raise_errors=True
+    )
+    return response[0] if response else None
@@ -0,0 +1,408 @@
+import asyncio
+import time
+import uuid
+from itertools import groupby
+from typing import Any, Dict, List, Optional, Tuple
+from telegram import Bot, InputMediaPhoto, InputMediaVideo, InputMediaDocument, InputMediaAudio
+from telegram.error import RetryAfter, Forbidden, BadRequest
+import redis.asyncio as aioredis
+from redis.exceptions import WatchError
+from config import (
+    logger, REDIS_URL, GLOBAL_SEND_RATE, CHAT_SEND_RATE, CHAT_SEND_BURST,
+    DELIVERY_CONCURRENCY, COALESCE_TEXT, DELIVERY_LEDGER_TTL
+)
+from content import to_items
+
+# Методы Bot API для каждого типа контента
+SEND_METHODS = {
+    'text': 'send_message',
+    'stickers': 'send_sticker',
+    'photos': 'send_photo',
+    'documents': 'send_document',
+    'voices': 'send_voice',
+    'videos': 'send_video',
+    'audios': 'send_audio'
+}
+# Типы контента, которые можно отправлять альбомом через send_media_group
+MEDIA_GROUP_TYPES = {
+    'photos': InputMediaPhoto,
+    'videos': InputMediaVideo,
+    'documents': InputMediaDocument,
+    'audios': InputMediaAudio
+}
+MEDIA_GROUP_SIZE = 10
+MAX_MESSAGE_LENGTH = 4096
+TEXT_SEPARATOR = "\n\n"
+MAX_SEND_ATTEMPTS = 5
+
+# Результаты доставки в чат
+DELIVERED = "delivered"
+SKIPPED = "skipped"
+FAILED = "failed"
+# Отметка в журнале для чатов, куда отправка невозможна
+SKIPPED_MARK = -1
+# Ошибки BadRequest, после которых в чат нельзя отправить ничего; остальные
+# относятся к отдельному элементу (например, неверный file_id)
+CHAT_ERRORS = (
+    "chat not found",
+    "user not found",
+    "peer_id_invalid",
+    "have no rights to send",
+    "not enough rights",
+    "chat_write_forbidden",
+    "bot was kicked"
+)
+
+DeliveryItem = Tuple[str, Any]
+
+def is_chat_error(error: Exception) -> bool:
+    """Означает ли ошибка, что чат недоступен целиком, а не только этот элемент."""
+    if isinstance(error, Forbidden):
+        return True
+    message = str(error).lower()
+    return isinstance(error, BadRequest) and any(text in message for text in CHAT_ERRORS)
+
+class TokenBucket:
+    """Ограничитель частоты запросов по алгоритму token bucket."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.max_rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self):
+        """Ожидание и списание одного токена."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """Приостановка выдачи токенов и снижение скорости после RetryAfter."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+        self.rate = max(self.max_rate / 8, self.rate / 2)
+
+    def recover(self):
+        """Постепенное восстановление скорости после успешного запроса."""
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 50)
+
+class SharedRateLimiter:
+    """Общий для всех процессов бота и воркеров лимит частоты запросов в Redis.
+
+    Запросы считаются в окнах по одной секунде; пауза после RetryAfter тоже
+    хранится в Redis и действует на все процессы. Без url или при недоступном
+    Redis используется локальный TokenBucket.
+    """
+
+    def __init__(self, url: Optional[str], rate: float, prefix: str = "send_rate:"):
+        self.url = url
+        self.rate = rate
+        self.max_rate = rate
+        self.prefix = prefix
+        self.fallback = TokenBucket(rate, rate)
+        self._client: Optional[aioredis.Redis] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _get_client(self) -> aioredis.Redis:
+        """Клиент Redis, привязанный к текущему циклу событий."""
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._loop is not loop:
+            self._client = aioredis.from_url(self.url)
+            self._loop = loop
+        return self._client
+
+    async def acquire(self):
+        """Ожидание свободного места в общем лимите текущей секунды."""
+        if not self.url:
+            await self.fallback.acquire()
+            return
+        while True:
+            try:
+                client = self._get_client()
+                paused = await client.pttl(f"{self.prefix}paused")
+                if paused > 0:
+                    await asyncio.sleep(paused / 1000)
+                    continue
+                now = time.time()
+                key = f"{self.prefix}{int(now)}"
+                async with client.pipeline(transaction=True) as pipe:
+                    pipe.incr(key)
+                    pipe.expire(key, 2)
+                    count, _ = await pipe.execute()
+            except Exception as e:
+                logger.warning(f"Общий лимит отправки в Redis недоступен, используется локальный: {e}")
+                await self.fallback.acquire()
+                return
+            if count <= self.rate:
+                return
+            await asyncio.sleep(int(now) + 1 - now)
+
+    async def pause(self, seconds: float):
+        """Приостановка отправки во всех процессах и снижение скорости после RetryAfter."""
+        self.fallback.pause(seconds)
+        self.rate = max(self.max_rate / 8, self.rate / 2)
+        if not self.url:
+            return
+        try:
+            client = self._get_client()
+            if await client.pttl(f"{self.prefix}paused") < seconds * 1000:
+                await client.set(f"{self.prefix}paused", 1, px=max(1, int(seconds * 1000)))
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить паузу отправки в Redis: {e}")
+
+    def recover(self):
+        """Постепенное восстановление скорости после успешного запроса."""
+        self.fallback.recover()
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 50)
+
+    async def close(self):
+        """Закрытие соединения с Redis."""
+        if self._client is not None and self._loop is asyncio.get_running_loop():
+            await self._client.aclose()
+        self._client = None
+        self._loop = None
+
+def _split_long_text(text: str, limit: int) -> List[str]:
+    """Разбиение слишком длинного текста на части по границам слов."""
+    parts = []
+    while len(text) > limit:
+        cut = max(text.rfind(" ", 0, limit + 1), text.rfind("\n", 0, limit + 1))
+        if cut <= 0:
+            cut = limit
+        parts.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+    if text:
+        parts.append(text)
+    return parts
+
+def coalesce_texts(texts: List[str], limit: int = MAX_MESSAGE_LENGTH) -> List[str]:
+    """Объединение подряд идущих текстов в минимальное число сообщений."""
+    messages = []
+    current = ""
+    for text in texts:
+        for part in _split_long_text(text, limit):
+            if current and len(current) + len(TEXT_SEPARATOR) + len(part) <= limit:
+                current += TEXT_SEPARATOR + part
+                continue
+            if current:
+                messages.append(current)
+            current = part
+    if current:
+        messages.append(current)
+    return messages
+
+def build_content_items(content, coalesce_text: bool = COALESCE_TEXT) -> List[DeliveryItem]:
+    """Преобразование содержимого капсулы в список элементов для отправки.
+
+    Элементы отправляются в порядке добавления; подряд идущие фото, видео,
+    документы и аудио одного типа объединяются в альбомы, подряд идущие
+    тексты при coalesce_text — в сообщения до 4096 символов.
+    """
+    items = []
+    for kind, group in groupby(to_items(content), key=lambda item: item[0]):
+        values = [value for _, value in group]
+        if kind == 'text' and coalesce_text:
+            items.extend(('text', message) for message in coalesce_texts(values))
+            continue
+        if kind not in MEDIA_GROUP_TYPES:
+            items.extend((kind, value) for value in values)
+            continue
+        for start in range(0, len(values), MEDIA_GROUP_SIZE):
+            chunk = values[start:start + MEDIA_GROUP_SIZE]
+            if len(chunk) > 1:
+                items.append(('media_group', [(kind, value) for value in chunk]))
+            else:
+                items.append((kind, chunk[0]))
+    return items
+
+class RedisLock:
+    """Блокировка в Redis с меткой владельца: чужую блокировку нельзя продлить или снять."""
+
+    def __init__(self, redis_client, lock_key: str):
+        self.redis = redis_client
+        self.lock_key = lock_key
+        self.token = uuid.uuid4().hex
+
+    async def acquire(self, timeout: int) -> bool:
+        """Захват блокировки на timeout секунд."""
+        return bool(await self.redis.set(self.lock_key, self.token, nx=True, ex=timeout))
+
+    async def _if_owner(self, action) -> bool:
+        """Атомарное выполнение действия с блокировкой, только если она принадлежит этому владельцу."""
+        async with self.redis.pipeline(transaction=True) as pipe:
+            try:
+                await pipe.watch(self.lock_key)
+                owner = await pipe.get(self.lock_key)
+                if owner is None or owner.decode() != self.token:
+                    await pipe.unwatch()
+                    return False
+                pipe.multi()
+                action(pipe)
+                await pipe.execute()
+                return True
+            except WatchError:
+                return False
+
+    async def extend(self, timeout: int) -> bool:
+        """Продление блокировки; False, если она истекла или захвачена другим владельцем."""
+        return await self._if_owner(lambda pipe: pipe.expire(self.lock_key, timeout))
+
+    async def release(self):
+        """Снятие блокировки, если она ещё принадлежит этому владельцу."""
+        await self._if_owner(lambda pipe: pipe.delete(self.lock_key))
+
+class DeliveryLedger(RedisLock):
+    """Журнал доставки капсулы в Redis: сколько элементов уже получил каждый чат.
+
+    Блокировка журнала не даёт двум задачам отправлять капсулу одновременно.
+    """
+
+    def __init__(self, redis_client, capsule_id: int, ttl: int = DELIVERY_LEDGER_TTL):
+        super().__init__(redis_client, f"delivery_lock:{capsule_id}")
+        self.key = f"delivery:{capsule_id}"
+        self.ttl = ttl
+
+    async def progress(self, chat_ids: List[int]) -> Dict[int, int]:
+        """Получение числа доставленных элементов для каждого чата."""
+        if not chat_ids:
+            return {}
+        values = await self.redis.hmget(self.key, [str(chat_id) for chat_id in chat_ids])
+        return {chat_id: int(value) for chat_id, value in zip(chat_ids, values) if value is not None}
+
+    async def mark(self, chat_id: int, delivered: int):
+        """Запись числа доставленных элементов для чата."""
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hset(self.key, str(chat_id), delivered)
+            pipe.expire(self.key, self.ttl)
+            await pipe.execute()
+
+    async def clear(self):
+        """Удаление журнала после полной доставки."""
+        await self.redis.delete(self.key)
+
+class DeliveryEngine:
+    """Параллельная отправка капсул получателям с соблюдением лимитов Telegram."""
+
+    def __init__(
+        self,
+        bot: Bot,
+        global_rate: float = GLOBAL_SEND_RATE,
+        chat_rate: float = CHAT_SEND_RATE,
+        chat_burst: float = CHAT_SEND_BURST,
+        concurrency: int = DELIVERY_CONCURRENCY,
+        redis_url: Optional[str] = REDIS_URL
+    ):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        # Лимит на весь токен бота: общий для всех процессов через Redis
+        self.global_limit = SharedRateLimiter(redis_url, global_rate)
+        self.chat_buckets: Dict[int, TokenBucket] = {}
+        self.chat_users: Dict[int, int] = {}
+        self.semaphore = asyncio.Semaphore(concurrency)
+
+    async def _send_item(self, chat_id: int, item: DeliveryItem):
+        kind, payload = item
+        if kind == 'media_group':
+            media = [MEDIA_GROUP_TYPES[media_kind](value) for media_kind, value in payload]
+            await self.bot.send_media_group(chat_id, media)
+        else:
+            await getattr(self.bot, SEND_METHODS[kind])(chat_id, payload)
+
+    async def _send_with_limits(self, chat_id: int, item: DeliveryItem, bucket: TokenBucket):
+        for attempt in range(1, MAX_SEND_ATTEMPTS + 1):
+            await bucket.acquire()
+            await self.global_limit.acquire()
+            try:
+                await self._send_item(chat_id, item)
+                self.global_limit.recover()
+                return
+            except RetryAfter as e:
+                logger.warning(f"Лимит Telegram для чата {chat_id}, пауза {e.retry_after} с (попытка {attempt})")
+                await self.global_limit.pause(e.retry_after)
+                bucket.pause(e.retry_after)
+                if attempt == MAX_SEND_ATTEMPTS:
+                    raise
+            except BadRequest as e:
+                if is_chat_error(e):
+                    raise
+                if item[0] != 'media_group':
+                    logger.warning(f"Элемент {item[0]} не отправлен в чат {chat_id}, пропускаю: {e}")
+                    return
+                logger.warning(f"Альбом не отправлен в чат {chat_id}, отправляю по одному: {e}")
+                for single in item[1]:
+                    await self._send_with_limits(chat_id, single, bucket)
+                return
+
+    async def _deliver_to_chat(
+        self,
+        chat_id: int,
+        items: List[DeliveryItem],
+        start: int = 0,
+        ledger: Optional[DeliveryLedger] = None
+    ) -> str:
+        if start == SKIPPED_MARK:
+            return SKIPPED
+        bucket = self.chat_buckets.setdefault(chat_id, TokenBucket(self.chat_rate, self.chat_burst))
+        self.chat_users[chat_id] = self.chat_users.get(chat_id, 0) + 1
+        try:
+            async with self.semaphore:
+                for index in range(start, len(items)):
+                    await self._send_with_limits(chat_id, items[index], bucket)
+                    if ledger:
+                        await ledger.mark(chat_id, index + 1)
+            return DELIVERED
+        except (Forbidden, BadRequest) as e:
+            logger.warning(f"Чат {chat_id} недоступен для отправки: {e}")
+            if ledger:
+                await ledger.mark(chat_id, SKIPPED_MARK)
+            return SKIPPED
+        except Exception as e:
+            logger.error(f"Ошибка отправки в чат {chat_id}: {e}")
+            return FAILED
+        finally:
+            self.chat_users[chat_id] -= 1
+            if not self.chat_users[chat_id]:
+                del self.chat_users[chat_id]
+                del self.chat_buckets[chat_id]
+
+    async def deliver(
+        self,
+        chat_ids: List[int],
+        items: List[DeliveryItem],
+        ledger: Optional[DeliveryLedger] = None
+    ) -> Dict[int, str]:
+        """Отправка элементов во все чаты параллельно с сохранением порядка внутри чата.
+
+        Если передан журнал, отправка в каждый чат продолжается с первого
+        недоставленного элемента, а прогресс сохраняется после каждого элемента.
+        """
+        chat_ids = list(dict.fromkeys(chat_ids))
+        progress = await ledger.progress(chat_ids) if ledger else {}
+        results = await asyncio.gather(*(
+            self._deliver_to_chat(chat_id, items, progress.get(chat_id, 0), ledger)
+            for chat_id in chat_ids
+        ))
+        return dict(zip(chat_ids, results))
+
+    async def close(self):
+        """Закрытие соединения общего лимита с Redis."""
+        await self.global_limit.close()
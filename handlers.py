@@ -1,15 +1,17 @@
-import json
 from datetime import datetime, timedelta
 from telegram import Update, ReplyKeyboardMarkup, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import CallbackContext
-from config import logger, ENCRYPTION_KEY_BYTES
-from crypto import decrypt_data_aes
+from config import logger
+from crypto import decrypt_content_async
 from localization import t, LOCALE
 from database import (
-    fetch_data, post_data, add_user, create_capsule, add_recipient,
-    get_user_capsules, get_capsule_recipients, delete_capsule,
-    generate_unique_capsule_number, update_data, get_chat_id
+    add_user, create_capsule, add_recipients,
+    get_user_capsules_page, get_capsule_recipients, delete_capsule,
+    generate_unique_capsule_number, get_capsule_content, get_delivery_bundle,
+    get_capsule_meta
 )
+from delivery import DeliveryEngine, build_content_items, DELIVERED
+from content import add_item, count_items
 from utils import check_capsule_ownership, save_capsule_content, convert_to_utc, save_send_date
 import pytz
 
@@ -23,7 +25,7 @@ SELECTING_CAPSULE_FOR_RECIPIENTS = "selecting_capsule_for_recipients"
 async def start(update: Update, context: CallbackContext):
     """Обработчик команды /start."""
     user = update.effective_user
-    add_user(user.username or str(user.id), user.id, update.effective_chat.id)
+    await add_user(user.username or str(user.id), user.id, update.effective_chat.id)
     keyboard = [
         [t("create_capsule_btn", locale=LOCALE), t("view_capsules_btn", locale=LOCALE)],
         [t("add_recipient_btn", locale=LOCALE), t("send_capsule_btn", locale=LOCALE)],
@@ -51,36 +53,43 @@ async def help_command(update: Update, context: CallbackContext):
 async def create_capsule_command(update: Update, context: CallbackContext):
     """Обработчик команды /create_capsule — начало пошагового мастера."""
     context.user_data['state'] = CREATING_CAPSULE_TITLE
-    context.user_data['capsule_content'] = {"text": [], "photos": [], "videos": [], "audios": [],
-                                            "documents": [], "stickers": [], "voices": []}
+    context.user_data['capsule_content'] = []
     await update.effective_message.reply_text("📦 Введите название капсулы:")
 
-async def show_capsule_selection(update: Update, context: CallbackContext, action: str):
+def build_page_navigation(action: str, page: int, total_pages: int, capsules: list) -> list:
+    """Кнопки перехода между страницами; callback_data несёт курсор (id крайней капсулы)."""
+    nav_buttons = []
+    if page > 1:
+        nav_buttons.append(InlineKeyboardButton("⬅️ Предыдущая", callback_data=f"{action}_prev_{page-1}_{capsules[0]['id']}"))
+    if page < total_pages:
+        nav_buttons.append(InlineKeyboardButton("Следующая ➡️", callback_data=f"{action}_next_{page+1}_{capsules[-1]['id']}"))
+    return nav_buttons
+
+async def load_capsule_page(update: Update, per_page: int, page: int = 1, direction: str = None, cursor: int = None):
+    """Загрузка одной страницы капсул пользователя по курсору."""
+    capsules, total = await get_user_capsules_page(
+        update.effective_user.id,
+        per_page,
+        after_id=cursor if direction == "next" else None,
+        before_id=cursor if direction == "prev" else None
+    )
+    total_pages = (total + per_page - 1) // per_page
+    if direction is None:
+        page = 1
+    return capsules, max(1, min(page, total_pages)), total_pages
+
+async def show_capsule_selection(update: Update, context: CallbackContext, action: str, page: int = 1, direction: str = None, cursor: int = None):
     """Отображение инлайн-меню для выбора капсулы с пагинацией."""
-    capsules = get_user_capsules(update.effective_user.id)
+    capsules, page, total_pages = await load_capsule_page(update, 10, page, direction, cursor)
     if not capsules:
         await update.effective_message.reply_text(t('no_capsules', locale=LOCALE))
         return False
 
-    capsules = sorted(capsules, key=lambda x: x['id'])
-    logger.info(f"Найдено {len(capsules)} капсул для пользователя {update.effective_user.id}")
-
-    page_key = f"{action}_page"
-    page = context.user_data.get(page_key, 1)
-    capsules_per_page = 10
-    total_pages = (len(capsules) + capsules_per_page - 1) // capsules_per_page
-
-    page = max(1, min(page, total_pages))
-    logger.info(f"Отображение страницы {page} из {total_pages} для действия {action}")
-
-    start_idx = (page - 1) * capsules_per_page
-    end_idx = start_idx + capsules_per_page
-    current_capsules = capsules[start_idx:end_idx]
-    logger.info(f"Выбраны капсулы с индекса {start_idx} по {end_idx}: {len(current_capsules)} капсул")
+    logger.info(f"Отображение страницы {page} из {total_pages} для действия {action}: {len(capsules)} капсул")
 
     keyboard = []
     row = []
-    for i, capsule in enumerate(current_capsules):
+    for i, capsule in enumerate(capsules):
         button_text = f"📦 #{capsule['id']}: {capsule['title']}"[:30]
         button = InlineKeyboardButton(button_text, callback_data=f"{action}_{capsule['id']}")
         row.append(button)
@@ -90,11 +99,7 @@ async def show_capsule_selection(update: Update, context: CallbackContext, actio
     if row:
         keyboard.append(row)
 
-    nav_buttons = []
-    if page > 1:
-        nav_buttons.append(InlineKeyboardButton("⬅️ Предыдущая", callback_data=f"{action}_page_{page-1}"))
-    if page < total_pages:
-        nav_buttons.append(InlineKeyboardButton("Следующая ➡️", callback_data=f"{action}_page_{page+1}"))
+    nav_buttons = build_page_navigation(action, page, total_pages, capsules)
     if nav_buttons:
         keyboard.append(nav_buttons)
 
@@ -105,7 +110,6 @@ async def show_capsule_selection(update: Update, context: CallbackContext, actio
     else:
         await update.effective_message.reply_text(response, reply_markup=reply_markup)
 
-    context.user_data[page_key] = page
     context.user_data['action'] = action
     return True
 
@@ -114,10 +118,10 @@ async def add_recipient_command(update: Update, context: CallbackContext):
     if await show_capsule_selection(update, context, "add_recipient"):
         context.user_data['state'] = SELECTING_CAPSULE_FOR_RECIPIENTS
 
-async def view_capsules_command(update: Update, context: CallbackContext):
+async def view_capsules_command(update: Update, context: CallbackContext, page: int = 1, direction: str = None, cursor: int = None):
     """Обработчик команды /view_capsules с улучшенным отображением и пагинацией."""
     try:
-        capsules = get_user_capsules(update.effective_user.id)
+        capsules, page, total_pages = await load_capsule_page(update, 5, page, direction, cursor)
         if not capsules:
             if update.callback_query:
                 await update.callback_query.edit_message_text(t('no_capsules', locale=LOCALE))
@@ -125,30 +129,14 @@ async def view_capsules_command(update: Update, context: CallbackContext):
                 await update.effective_message.reply_text(t('no_capsules', locale=LOCALE))
             return
 
-        capsules = sorted(capsules, key=lambda x: x['id'])
-
-        page = context.user_data.get('view_capsules_page', 1)
-        capsules_per_page = 5
-        total_pages = (len(capsules) + capsules_per_page - 1) // capsules_per_page
-
-        page = max(1, min(page, total_pages))
-
-        start_idx = (page - 1) * capsules_per_page
-        end_idx = start_idx + capsules_per_page
-        current_capsules = capsules[start_idx:end_idx]
-
         response = f"📋 {t('your_capsules', locale=LOCALE)} (Страница {page} из {total_pages}):\n\n"
         keyboard = []
-        for capsule in current_capsules:
+        for capsule in capsules:
             button_text = f"📦 #{capsule['id']} {capsule['title']}"[:40]
             button = InlineKeyboardButton(button_text, callback_data=f"view_{capsule['id']}")
             keyboard.append([button])
 
-        nav_buttons = []
-        if page > 1:
-            nav_buttons.append(InlineKeyboardButton("⬅️ Предыдущая", callback_data=f"view_page_{page-1}"))
-        if page < total_pages:
-            nav_buttons.append(InlineKeyboardButton("Следующая ➡️", callback_data=f"view_page_{page+1}"))
+        nav_buttons = build_page_navigation("view", page, total_pages, capsules)
         if nav_buttons:
             keyboard.append(nav_buttons)
 
@@ -159,8 +147,6 @@ async def view_capsules_command(update: Update, context: CallbackContext):
         else:
             await update.effective_message.reply_text(response, reply_markup=reply_markup)
 
-        context.user_data['view_capsules_page'] = page
-
     except Exception as e:
         logger.error(f"Ошибка при получении капсул: {e}")
         if update.callback_query:
@@ -244,12 +230,16 @@ async def handle_inline_selection(update: Update, context: CallbackContext):
         if len(parts) < 2:
             raise ValueError("Неверный формат callback_data")
 
-        if parts[-2] == "page":
-            action_type = "_".join(parts[:-2])
-            page_number = int(parts[-1])
-            context.user_data[f"{action_type}_page"] = page_number
+        if len(parts) >= 4 and parts[-3] in ("next", "prev"):
+            action_type = "_".join(parts[:-3])
+            direction = parts[-3]
+            page_number = int(parts[-2])
+            cursor = int(parts[-1])
             logger.info(f"Переход на страницу {page_number} для действия {action_type}")
-            await show_capsule_selection(update, context, action_type)
+            if action_type == "view":
+                await view_capsules_command(update, context, page_number, direction, cursor)
+            else:
+                await show_capsule_selection(update, context, action_type, page_number, direction, cursor)
             return
         else:
             action = "_".join(parts[:-1])
@@ -293,27 +283,34 @@ async def handle_inline_selection(update: Update, context: CallbackContext):
 
 async def preview_capsule(update: Update, context: CallbackContext, capsule_id: int, show_buttons: bool = True):
     """Предпросмотр капсулы перед отправкой или просмотром."""
-    capsule = fetch_data("capsules", {"id": capsule_id})
+    capsule = await get_capsule_meta(capsule_id)
     if not capsule:
         await update.callback_query.edit_message_text(t('invalid_capsule_id', locale=LOCALE))
         return
 
-    content = json.loads(decrypt_data_aes(capsule[0]['content'], ENCRYPTION_KEY_BYTES))
+    manifest = capsule['content_manifest']
+    content = None
+    if not manifest or manifest['counts'].get('text'):
+        encrypted = await get_capsule_content(capsule_id)
+        content = await decrypt_content_async(encrypted) if encrypted else []
+    counts = manifest['counts'] if manifest else count_items(content)
+    texts = [value for kind, value in content if kind == 'text'] if content else []
+
     preview_text = "📦 Предпросмотр капсулы:\n"
-    if content.get('text'):
-        preview_text += f"Текст:\n" + "\n".join(content['text']) + "\n"
-    if content.get('photos'):
-        preview_text += f"Фото: {len(content['photos'])} шт.\n"
-    if content.get('videos'):
-        preview_text += f"Видео: {len(content['videos'])} шт.\n"
-    if content.get('audios'):
-        preview_text += f"Аудио: {len(content['audios'])} шт.\n"
-    if content.get('documents'):
-        preview_text += f"Документы: {len(content['documents'])} шт.\n"
-    if content.get('stickers'):
-        preview_text += f"Стикеры: {len(content['stickers'])} шт.\n"
-    if content.get('voices'):
-        preview_text += f"Голосовые: {len(content['voices'])} шт.\n"
+    if texts:
+        preview_text += f"Текст:\n" + "\n".join(texts) + "\n"
+    if counts.get('photos'):
+        preview_text += f"Фото: {counts['photos']} шт.\n"
+    if counts.get('videos'):
+        preview_text += f"Видео: {counts['videos']} шт.\n"
+    if counts.get('audios'):
+        preview_text += f"Аудио: {counts['audios']} шт.\n"
+    if counts.get('documents'):
+        preview_text += f"Документы: {counts['documents']} шт.\n"
+    if counts.get('stickers'):
+        preview_text += f"Стикеры: {counts['stickers']} шт.\n"
+    if counts.get('voices'):
+        preview_text += f"Голосовые: {counts['voices']} шт.\n"
 
     if show_buttons:
         keyboard = [
@@ -354,7 +351,7 @@ async def handle_delete_confirmation(update: Update, context: CallbackContext):
     query = update.callback_query
     if query.data == "confirm_delete":
         capsule_id = context.user_data.get('selected_capsule_id')
-        delete_capsule(capsule_id)
+        await delete_capsule(capsule_id)
         await query.edit_message_text(t('capsule_deleted', capsule_id=capsule_id, locale=LOCALE))
     else:
         await query.edit_message_text(t('delete_canceled', locale=LOCALE))
@@ -409,9 +406,7 @@ async def handle_capsule_title(update: Update, context: CallbackContext, title:
 
 async def handle_create_capsule_content(update: Update, context: CallbackContext, text: str):
     """Обработка добавления текстового контента в капсулу."""
-    capsule_content = context.user_data.get('capsule_content', {"text": []})
-    capsule_content['text'].append(text)
-    context.user_data['capsule_content'] = capsule_content
+    context.user_data['capsule_content'] = add_item(context.user_data.get('capsule_content'), 'text', text)
     keyboard = [
         [InlineKeyboardButton("Завершить", callback_data="finish_capsule"),
          InlineKeyboardButton("Добавить ещё", callback_data="add_more")]
@@ -425,16 +420,15 @@ async def handle_content_buttons(update: Update, context: CallbackContext):
     query = update.callback_query
     if query.data == "finish_capsule":
         user = update.effective_user
-        existing_user = fetch_data("users", {"telegram_id": user.id})
-        creator_id = existing_user[0]['id'] if existing_user else post_data("users", {
-            "telegram_id": user.id,
-            "username": user.username or str(user.id),
-            "chat_id": update.effective_chat.id
-        })[0]['id']
-
-        content = json.dumps(context.user_data['capsule_content'], ensure_ascii=False)
-        user_capsule_number = generate_unique_capsule_number(creator_id)
-        capsule_id = create_capsule(creator_id, context.user_data['capsule_title'], content, user_capsule_number)
+        creator = await add_user(user.username or str(user.id), user.id, update.effective_chat.id)
+        creator_id = creator['id']
+
+        content = context.user_data['capsule_content']
+        user_capsule_number = await generate_unique_capsule_number(creator_id)
+        capsule_id = await create_capsule(creator_id, context.user_data['capsule_title'], content, user_capsule_number)
+        if capsule_id == -1:
+            await query.edit_message_text(t('error_general', locale=LOCALE))
+            return
         context.user_data['current_capsule'] = capsule_id
         context.user_data['state'] = CREATING_CAPSULE_RECIPIENTS
         await query.edit_message_text(t('capsule_created', capsule_id=capsule_id, locale=LOCALE) + "\n👥 Укажите получателей (например, @Friend1 @Friend2):")
@@ -476,10 +470,9 @@ async def finalize_capsule_creation(update: Update, context: CallbackContext):
 async def handle_recipient(update: Update, context: CallbackContext):
     """Обработчик добавления получателей."""
     try:
-        usernames = set(update.message.text.strip().split())
+        usernames = [username.lstrip('@') for username in update.message.text.strip().split()]
         capsule_id = context.user_data.get('current_capsule') or context.user_data.get('selected_capsule_id')
-        for username in usernames:
-            add_recipient(capsule_id, username.lstrip('@'))
+        await add_recipients(capsule_id, usernames)
         await update.effective_message.reply_text(t('recipients_added', capsule_id=capsule_id, locale=LOCALE))
         context.user_data['state'] = "idle"
     except Exception as e:
@@ -489,39 +482,31 @@ async def handle_recipient(update: Update, context: CallbackContext):
 async def handle_send_capsule_logic(update: Update, context: CallbackContext, capsule_id: int):
     """Логика отправки капсулы."""
     try:
-        capsule = fetch_data("capsules", {"id": capsule_id})
-        if not capsule:
+        bundle = await get_delivery_bundle(capsule_id)
+        if not bundle or not bundle['content']:
             await update.callback_query.edit_message_text(t('invalid_capsule_id', locale=LOCALE))
             return
-        recipients = get_capsule_recipients(capsule_id)
-        if not recipients:
+        if not bundle['recipients']:
             await update.callback_query.edit_message_text(t('no_recipients', locale=LOCALE))
             return
-        content = json.loads(decrypt_data_aes(capsule[0]['content'], ENCRYPTION_KEY_BYTES))
-        for recipient in recipients:
-            chat_id = get_chat_id(recipient['recipient_username'])
-            if chat_id:
-                await context.bot.send_message(
-                    chat_id=chat_id,
-                    text=t('capsule_received', sender=update.effective_user.username or "Unknown", locale=LOCALE)
-                )
-                for item in content.get('text', []):
-                    await context.bot.send_message(chat_id, item)
-                for item in content.get('stickers', []):
-                    await context.bot.send_sticker(chat_id, item)
-                for item in content.get('photos', []):
-                    await context.bot.send_photo(chat_id, item)
-                for item in content.get('documents', []):
-                    await context.bot.send_document(chat_id, item)
-                for item in content.get('voices', []):
-                    await context.bot.send_voice(chat_id, item)
-                for item in content.get('videos', []):
-                    await context.bot.send_video(chat_id, item)
-                for item in content.get('audios', []):
-                    await context.bot.send_audio(chat_id, item)
-                await update.callback_query.edit_message_text(t('capsule_sent', recipient=recipient['recipient_username'], locale=LOCALE))
+        content = await decrypt_content_async(bundle['content'])
+        usernames = [recipient['username'] for recipient in bundle['recipients']]
+        chat_ids = {recipient['username']: recipient['chat_id'] for recipient in bundle['recipients'] if recipient['chat_id']}
+        engine = context.bot_data.get('delivery_engine')
+        if engine is None:
+            engine = context.bot_data['delivery_engine'] = DeliveryEngine(context.bot)
+        items = [('text', t('capsule_received', sender=update.effective_user.username or "Unknown", locale=LOCALE))]
+        results = await engine.deliver(list(chat_ids.values()), items + build_content_items(content))
+        report = []
+        for username in dict.fromkeys(usernames):
+            chat_id = chat_ids.get(username)
+            if chat_id and results.get(chat_id) == DELIVERED:
+                report.append(t('capsule_sent', recipient=username, locale=LOCALE))
+            elif chat_id:
+                report.append(t('capsule_send_failed', recipient=username, locale=LOCALE))
             else:
-                await update.callback_query.edit_message_text(t('recipient_not_registered', recipient=recipient['recipient_username'], locale=LOCALE))
+                report.append(t('recipient_not_registered', recipient=username, locale=LOCALE))
+        await update.callback_query.edit_message_text("\n".join(report))
     except Exception as e:
         logger.error(f"Ошибка при отправке капсулы: {e}")
         await update.callback_query.edit_message_text(t('service_unavailable', locale=LOCALE))
@@ -529,7 +514,7 @@ async def handle_send_capsule_logic(update: Update, context: CallbackContext, ca
 async def handle_view_recipients_logic(update: Update, context: CallbackContext, capsule_id: int):
     """Логика просмотра получателей капсулы."""
     try:
-        recipients = get_capsule_recipients(capsule_id)
+        recipients = await get_capsule_recipients(capsule_id)
         if recipients:
             recipient_list = "\n".join([f"@{r['recipient_username']}" for r in recipients])
             await update.callback_query.edit_message_text(t('recipients_list', capsule_id=capsule_id, recipients=recipient_list, locale=LOCALE))
@@ -545,25 +530,17 @@ async def handle_media(update: Update, context: CallbackContext, media_type: str
     if context.user_data.get('state') not in [CREATING_CAPSULE_CONTENT]:
         await update.effective_message.reply_text(t('create_capsule_first', locale=LOCALE))
         return
-    capsule_content = context.user_data.get('capsule_content', {media_type: []})
     try:
+        # file_id берётся из самого сообщения без запроса к API, чтобы элемент
+        # добавлялся сразу и альбом сохранял порядок сообщений
         if media_type == "photos":
-            file_id = (await update.message.photo[-1].get_file()).file_id
-        elif media_type == "videos":
-            file_id = (await update.message.video.get_file()).file_id
-        elif media_type == "audios":
-            file_id = (await update.message.audio.get_file()).file_id
-        elif media_type == "documents":
-            file_id = (await update.message.document.get_file()).file_id
-        elif media_type == "stickers":
-            file_id = (await update.message.sticker.get_file()).file_id
-        elif media_type == "voices":
-            file_id = (await update.message.voice.get_file()).file_id
+            file_id = update.message.photo[-1].file_id
+        elif media_type in ("videos", "audios", "documents", "stickers", "voices"):
+            file_id = getattr(update.message, file_attr).file_id
         else:
             raise ValueError(f"Неизвестный тип медиа: {media_type}")
 
-        capsule_content.setdefault(media_type, []).append(file_id)
-        context.user_data['capsule_content'] = capsule_content
+        context.user_data['capsule_content'] = add_item(context.user_data.get('capsule_content'), media_type, file_id)
         keyboard = [
             [InlineKeyboardButton("Завершить", callback_data="finish_capsule"),
              InlineKeyboardButton("Добавить ещё", callback_data="add_more")]
@@ -71,6 +71,7 @@ TRANSLATIONS = {
         "recipient_not_registered": (
             "⚠️ Получатель @{recipient} не зарегистрирован в боте и не получит капсулу."
         ),
+        "capsule_send_failed": "⚠️ Не удалось доставить капсулу @{recipient}. Попробуйте отправить её позже.",
         "confirm_delete": "🗑 Вы уверены, что хотите удалить капсулу? Это действие нельзя отменить.",
         "capsule_deleted": "✅ Капсула #{capsule_id} удалена.",
         "delete_canceled": "❌ Удаление отменено. Капсула осталась на месте.",
@@ -179,6 +180,7 @@ TRANSLATIONS = {
         "recipient_not_registered": (
             "⚠️ Recipient @{recipient} isn’t registered with the bot and won’t receive the capsule."
         ),
+        "capsule_send_failed": "⚠️ Couldn’t deliver the capsule to @{recipient}. Try sending it again later.",
         "confirm_delete": "🗑 Are you sure you want to delete this capsule? This action cannot be undone.",
         "capsule_deleted": "✅ Capsule #{capsule_id} deleted.",
         "delete_canceled": "❌ Deletion canceled. The capsule remains intact.",
@@ -285,6 +287,7 @@ TRANSLATIONS = {
         "recipient_not_registered": (
             "⚠️ El destinatario @{recipient} no está registrado en el bot y no recibirá la cápsula."
         ),
+        "capsule_send_failed": "⚠️ No se pudo entregar la cápsula a @{recipient}. Intenta enviarla más tarde.",
         "confirm_delete": "🗑 ¿Estás seguro de que quieres eliminar esta cápsula? Esta acción no se puede deshacer.",
         "capsule_deleted": "✅ Cápsula #{capsule_id} eliminada.",
         "delete_canceled": "❌ Eliminación cancelada. La cápsula permanece intacta.",
@@ -391,6 +394,7 @@ TRANSLATIONS = {
         "recipient_not_registered": (
             "⚠️ Le destinataire @{recipient} n'est pas enregistré avec le bot et ne recevra pas la capsule."
         ),
+        "capsule_send_failed": "⚠️ Impossible de livrer la capsule à @{recipient}. Réessayez plus tard.",
         "confirm_delete": "🗑 Êtes-vous sûr de vouloir supprimer cette capsule ? Cette action est irréversible.",
         "capsule_deleted": "✅ Capsule #{capsule_id} supprimée.",
         "delete_canceled": "❌ Suppression annulée. La capsule reste intacte.",
@@ -497,6 +501,7 @@ TRANSLATIONS = {
         "recipient_not_registered": (
             "⚠️ Der Empfänger @{recipient} ist nicht beim Bot registriert und erhält die Kapsel nicht."
         ),
+        "capsule_send_failed": "⚠️ Die Kapsel konnte nicht an @{recipient} zugestellt werden. Versuchen Sie es später erneut.",
         "confirm_delete": "🗑 Sind Sie sicher, dass Sie diese Kapsel löschen möchten? Diese Aktion kann nicht rückgängig gemacht werden.",
         "capsule_deleted": "✅ Kapsel #{capsule_id} gelöscht.",
         "delete_canceled": "❌ Löschen abgebrochen. Die Kapsel bleibt unversehrt.",
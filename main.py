@@ -1,4 +1,5 @@
 import sys
+import asyncio
 import nest_asyncio
 from telegram import Update
 from telegram.ext import (
@@ -7,7 +8,8 @@ from telegram.ext import (
     MessageHandler,
     filters,
     CallbackQueryHandler,
-    CallbackContext
+    CallbackContext,
+    TypeHandler
 )
 from config import TELEGRAM_TOKEN, logger, celery_app, start_services
 from handlers import (
@@ -20,8 +22,7 @@ from handlers import (
     handle_sticker, handle_voice, handle_inline_selection,
     handle_content_buttons, handle_send_confirmation
 )
-from utils import post_init, check_bot_permissions
-from celery.result import AsyncResult
+from utils import post_init, post_shutdown, check_bot_permissions, start_unit_of_work, sequential_per_user
 
 # Обработчик ошибок
 async def error_handler(update: Update, context: CallbackContext) -> None:
@@ -38,20 +39,16 @@ async def error_handler(update: Update, context: CallbackContext) -> None:
         except Exception as e:
             logger.error(f"Не удалось отправить сообщение об ошибке через callback: {e}")
 
-# Проверка задачи Celery
+# Проверка воркеров Celery: ping не ставит задач в очередь и ничего не отправляет
 async def check_celery_task(celery_app):
     try:
-        result = celery_app.send_task('main.send_capsule_task', args=[1], countdown=10)
-        async_result = AsyncResult(result.id, app=celery_app)
-        logger.info(f"Статус задачи Celery: {async_result.status}")
-        if async_result.status == 'PENDING':
-            logger.info("Задача Celery ожидает выполнения.")
-        elif async_result.status == 'SUCCESS':
-            logger.info("Задача Celery выполнена успешно.")
+        replies = await asyncio.to_thread(celery_app.control.ping, timeout=1.0)
+        if replies:
+            logger.info(f"Воркеры Celery отвечают: {len(replies)}")
         else:
-            logger.error(f"Задача Celery завершилась с ошибкой: {async_result.status}")
+            logger.warning("Ни один воркер Celery не ответил на ping")
     except Exception as e:
-        logger.error(f"Ошибка проверки задачи Celery: {e}")
+        logger.error(f"Ошибка проверки воркеров Celery: {e}")
 
 # Проверка запуска бота
 async def check_bot_running(context: CallbackContext):
@@ -70,37 +67,45 @@ async def main():
         start_services()
 
         logger.info("Инициализация приложения Telegram...")
-        app = ApplicationBuilder().token(TELEGRAM_TOKEN).post_init(post_init).build()
+        app = (
+            ApplicationBuilder()
+            .token(TELEGRAM_TOKEN)
+            .concurrent_updates(True)
+            .post_init(post_init)
+            .post_shutdown(post_shutdown)
+            .build()
+        )
 
         app.add_error_handler(error_handler)
 
         logger.info("Регистрация обработчиков команд...")
-        app.add_handler(CommandHandler("start", start))
-        app.add_handler(CommandHandler("help", help_command))
-        app.add_handler(CommandHandler("create_capsule", create_capsule_command))
-        app.add_handler(CommandHandler("add_recipient", add_recipient_command))
-        app.add_handler(CommandHandler("view_capsules", view_capsules_command))
-        app.add_handler(CommandHandler("send_capsule", send_capsule_command))
-        app.add_handler(CommandHandler("delete_capsule", delete_capsule_command))
-        app.add_handler(CommandHandler("view_recipients", view_recipients_command))
-        app.add_handler(CommandHandler("select_send_date", select_send_date))
-        app.add_handler(CommandHandler("support_author", support_author))
-        app.add_handler(CommandHandler("change_language", change_language))
+        app.add_handler(TypeHandler(Update, start_unit_of_work), group=-1)
+        app.add_handler(CommandHandler("start", sequential_per_user(start)))
+        app.add_handler(CommandHandler("help", sequential_per_user(help_command)))
+        app.add_handler(CommandHandler("create_capsule", sequential_per_user(create_capsule_command)))
+        app.add_handler(CommandHandler("add_recipient", sequential_per_user(add_recipient_command)))
+        app.add_handler(CommandHandler("view_capsules", sequential_per_user(view_capsules_command)))
+        app.add_handler(CommandHandler("send_capsule", sequential_per_user(send_capsule_command)))
+        app.add_handler(CommandHandler("delete_capsule", sequential_per_user(delete_capsule_command)))
+        app.add_handler(CommandHandler("view_recipients", sequential_per_user(view_recipients_command)))
+        app.add_handler(CommandHandler("select_send_date", sequential_per_user(select_send_date)))
+        app.add_handler(CommandHandler("support_author", sequential_per_user(support_author)))
+        app.add_handler(CommandHandler("change_language", sequential_per_user(change_language)))
 
-        app.add_handler(CallbackQueryHandler(handle_language_selection, pattern=r"^(ru|en|es|fr|de)$"))
-        app.add_handler(CallbackQueryHandler(handle_date_buttons, pattern=r"^(week|month|custom)$"))
-        app.add_handler(CallbackQueryHandler(handle_delete_confirmation, pattern=r"^(confirm_delete|cancel_delete)$"))
-        app.add_handler(CallbackQueryHandler(handle_inline_selection, pattern=r"^(add_recipient|send_capsule|delete_capsule|view_recipients|select_send_date|view|add_recipient_page|send_capsule_page|delete_capsule_page|view_recipients_page|view_page)_\d+$"))
-        app.add_handler(CallbackQueryHandler(handle_content_buttons, pattern=r"^(finish_capsule|add_more)$"))
-        app.add_handler(CallbackQueryHandler(handle_send_confirmation, pattern=r"^(confirm_send|cancel_send)$"))
+        app.add_handler(CallbackQueryHandler(sequential_per_user(handle_language_selection), pattern=r"^(ru|en|es|fr|de)$"))
+        app.add_handler(CallbackQueryHandler(sequential_per_user(handle_date_buttons), pattern=r"^(week|month|custom)$"))
+        app.add_handler(CallbackQueryHandler(sequential_per_user(handle_delete_confirmation), pattern=r"^(confirm_delete|cancel_delete)$"))
+        app.add_handler(CallbackQueryHandler(sequential_per_user(handle_inline_selection), pattern=r"^(add_recipient|send_capsule|delete_capsule|view_recipients|select_send_date|view)_((next|prev)_\d+_)?\d+$"))
+        app.add_handler(CallbackQueryHandler(sequential_per_user(handle_content_buttons), pattern=r"^(finish_capsule|add_more)$"))
+        app.add_handler(CallbackQueryHandler(sequential_per_user(handle_send_confirmation), pattern=r"^(confirm_send|cancel_send)$"))
 
-        app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
-        app.add_handler(MessageHandler(filters.PHOTO, handle_photo))
-        app.add_handler(MessageHandler(filters.VIDEO, handle_video))
-        app.add_handler(MessageHandler(filters.AUDIO, handle_audio))
-        app.add_handler(MessageHandler(filters.Document.ALL, handle_document))
-        app.add_handler(MessageHandler(filters.Sticker.ALL, handle_sticker))
-        app.add_handler(MessageHandler(filters.VOICE, handle_voice))
+        app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, sequential_per_user(handle_text)))
+        app.add_handler(MessageHandler(filters.PHOTO, sequential_per_user(handle_photo)))
+        app.add_handler(MessageHandler(filters.VIDEO, sequential_per_user(handle_video)))
+        app.add_handler(MessageHandler(filters.AUDIO, sequential_per_user(handle_audio)))
+        app.add_handler(MessageHandler(filters.Document.ALL, sequential_per_user(handle_document)))
+        app.add_handler(MessageHandler(filters.Sticker.ALL, sequential_per_user(handle_sticker)))
+        app.add_handler(MessageHandler(filters.VOICE, sequential_per_user(handle_voice)))
 
         app.job_queue.run_once(check_bot_permissions, 2)
 
@@ -113,5 +118,4 @@ async def main():
         sys.exit(1)
 
 if __name__ == "__main__":
-    import asyncio
     asyncio.run(main())
@@ -0,0 +1,27 @@
+-- Планировщик отправки: капсулы забираются пачками по scheduled_at
+-- с арендой (lease), чтобы два тика не отправили одну капсулу дважды.
+
+alter table capsules add column if not exists dispatch_lease_until timestamptz;
+
+create index if not exists capsules_due_idx
+    on capsules (scheduled_at)
+    where is_sent = false;
+
+create or replace function claim_due_capsules(p_limit integer, p_lease_seconds integer)
+returns table (id bigint)
+language sql
+as $$
+    update capsules c
+    set dispatch_lease_until = now() + make_interval(secs => p_lease_seconds)
+    where c.id in (
+        select d.id
+        from capsules d
+        where d.is_sent = false
+          and d.scheduled_at <= now()
+          and (d.dispatch_lease_until is null or d.dispatch_lease_until < now())
+        order by d.scheduled_at
+        limit p_limit
+        for update skip locked
+    )
+    returning c.id;
+$$;
@@ -0,0 +1,47 @@
+-- Версия расписания капсулы: каждая смена даты увеличивает schedule_version,
+-- а задачи Celery с устаревшей версией отбрасываются без чтения содержимого.
+
+alter table capsules add column if not exists schedule_version integer not null default 0;
+alter table capsules add column if not exists dispatch_task_id text;
+
+drop function if exists claim_due_capsules(integer, integer);
+
+create or replace function claim_due_capsules(p_limit integer, p_lease_seconds integer)
+returns table (id bigint, schedule_version integer, dispatch_task_id text)
+language sql
+as $$
+    update capsules c
+    set dispatch_lease_until = now() + make_interval(secs => p_lease_seconds),
+        dispatch_task_id = gen_random_uuid()::text
+    where c.id in (
+        select d.id
+        from capsules d
+        where d.is_sent = false
+          and d.scheduled_at <= now()
+          and (d.dispatch_lease_until is null or d.dispatch_lease_until < now())
+        order by d.scheduled_at
+        limit p_limit
+        for update skip locked
+    )
+    returning c.id, c.schedule_version, c.dispatch_task_id;
+$$;
+
+create or replace function reschedule_capsule(p_capsule_id bigint, p_scheduled_at timestamptz)
+returns table (schedule_version integer, superseded_task_id text)
+language sql
+as $$
+    update capsules c
+    set scheduled_at = p_scheduled_at,
+        is_sent = false,
+        dispatch_lease_until = null,
+        dispatch_task_id = null,
+        schedule_version = c.schedule_version + 1
+    from (
+        select id, dispatch_task_id
+        from capsules
+        where id = p_capsule_id
+        for update
+    ) old
+    where c.id = old.id
+    returning c.schedule_version, old.dispatch_task_id;
+$$;
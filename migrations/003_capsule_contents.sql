@@ -0,0 +1,19 @@
+-- Содержимое капсул хранится отдельно от метаданных: списки и проверки
+-- читают только строку capsules, а зашифрованный блоб загружается лишь
+-- для предпросмотра и отправки.
+
+create table if not exists capsule_contents (
+    capsule_id bigint primary key references capsules(id) on delete cascade,
+    content text not null
+);
+
+alter table capsules add column if not exists content_manifest jsonb;
+
+insert into capsule_contents (capsule_id, content)
+select id, content
+from capsules
+where content is not null
+on conflict (capsule_id) do nothing;
+
+alter table capsules alter column content drop not null;
+update capsules set content = null where content is not null;
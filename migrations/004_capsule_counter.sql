@@ -0,0 +1,19 @@
+-- Атомарный счётчик номеров капсул пользователя вместо подсчёта всех его капсул.
+
+alter table users add column if not exists capsule_counter integer not null default 0;
+
+update users u
+set capsule_counter = coalesce(
+    (select max(c.user_capsule_number) from capsules c where c.creator_id = u.id),
+    0
+);
+
+create or replace function next_capsule_number(p_user_id bigint)
+returns integer
+language sql
+as $$
+    update users
+    set capsule_counter = capsule_counter + 1
+    where id = p_user_id
+    returning capsule_counter;
+$$;
@@ -0,0 +1,11 @@
+-- Один получатель не может быть добавлен к капсуле дважды:
+-- это позволяет добавлять получателей одной вставкой с пропуском дубликатов.
+
+delete from recipients r
+using recipients d
+where r.capsule_id = d.capsule_id
+  and r.recipient_username = d.recipient_username
+  and r.ctid > d.ctid;
+
+alter table recipients
+    add constraint recipients_capsule_username_key unique (capsule_id, recipient_username);
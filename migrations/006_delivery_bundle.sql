@@ -0,0 +1,28 @@
+-- Всё, что нужно для отправки капсулы, одним запросом: версия расписания,
+-- зашифрованное содержимое, имя отправителя и chat_id каждого получателя.
+
+create or replace function get_delivery_bundle(p_capsule_id bigint)
+returns jsonb
+language sql
+stable
+as $$
+    select jsonb_build_object(
+        'id', c.id,
+        'creator_id', c.creator_id,
+        'is_sent', c.is_sent,
+        'schedule_version', c.schedule_version,
+        'sender_username', (select u.username from users u where u.id = c.creator_id),
+        'content', coalesce(cc.content, c.content),
+        'recipients', coalesce((
+            select jsonb_agg(jsonb_build_object(
+                'username', r.recipient_username,
+                'chat_id', (select ru.chat_id from users ru where ru.username = r.recipient_username limit 1)
+            ))
+            from recipients r
+            where r.capsule_id = c.id
+        ), '[]'::jsonb)
+    )
+    from capsules c
+    left join capsule_contents cc on cc.capsule_id = c.id
+    where c.id = p_capsule_id;
+$$;
@@ -0,0 +1,18 @@
+-- Перешифрование содержимого новым ключом: пачка записывается одним запросом,
+-- строка обновляется, только если её содержимое не менялось с момента чтения
+-- (сверяется md5). Блокируются лишь обновляемые строки, а не вся таблица.
+
+create or replace function rotate_capsule_contents(p_rows jsonb)
+returns integer
+language sql
+as $$
+    with updated as (
+        update capsule_contents c
+        set content = r.content
+        from jsonb_to_recordset(p_rows) as r(capsule_id bigint, old_hash text, content text)
+        where c.capsule_id = r.capsule_id
+          and md5(c.content) = r.old_hash
+        returning 1
+    )
+    select count(*)::integer from updated;
+$$;
@@ -0,0 +1,475 @@
+import asyncio
+import hashlib
+import json
+import re
+import sqlite3
+import sys
+import uuid
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta, timezone
+from typing import Any, List, Optional, Tuple
+import aiohttp
+from config import (
+    logger, STORAGE_BACKEND, SQLITE_PATH, SUPABASE_REST_URL, SUPABASE_HEADERS,
+    DB_POOL_SIZE, DB_KEEPALIVE_TIMEOUT, DB_TIMEOUT
+)
+
+FILTER_OPERATORS = {"eq", "neq", "gt", "gte", "lt", "lte", "in", "is", "like", "ilike"}
+
+# Условие выборки: (столбец, оператор, значение)
+Filter = Tuple[str, str, Any]
+
+class MissingFunctionError(RuntimeError):
+    """Хранимая функция не найдена: её миграция ещё не применена."""
+
+class StorageBackend(ABC):
+    """Интерфейс хранилища, на котором построены функции database.py.
+
+    Условия передаются списком кортежей (столбец, оператор, значение),
+    оператор — один из FILTER_OPERATORS. Методы записи возвращают
+    затронутые строки целиком, ошибки пробрасываются вызывающему коду.
+    """
+
+    @abstractmethod
+    async def select(
+        self,
+        table: str,
+        filters: List[Filter],
+        columns: str = "*",
+        order: Optional[str] = None,
+        limit: Optional[int] = None,
+        offset: Optional[int] = None
+    ) -> list:
+        """Выборка строк; order — например "id" или "id.desc"."""
+
+    @abstractmethod
+    async def count(self, table: str, filters: List[Filter]) -> int:
+        """Точное число строк, подходящих под условия."""
+
+    @abstractmethod
+    async def insert(self, table: str, data) -> list:
+        """Вставка одной строки или списка строк."""
+
+    @abstractmethod
+    async def upsert(self, table: str, data, on_conflict: str, ignore_duplicates: bool = False) -> list:
+        """Вставка или обновление строк по уникальному ключу."""
+
+    @abstractmethod
+    async def update(self, table: str, filters: List[Filter], data: dict) -> list:
+        """Обновление строк, подходящих под условия."""
+
+    @abstractmethod
+    async def delete(self, table: str, filters: List[Filter]) -> list:
+        """Удаление строк, подходящих под условия."""
+
+    @abstractmethod
+    async def rpc(self, name: str, params: dict):
+        """Вызов хранимой функции; возвращает строки или скалярное значение."""
+
+    async def close(self):
+        """Освобождение соединений."""
+
+class SupabaseBackend(StorageBackend):
+    """Хранилище Supabase через PostgREST API с общим пулом HTTP-соединений."""
+
+    def __init__(self, rest_url: str, headers: dict):
+        self.rest_url = rest_url
+        self.headers = headers
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._session_loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def get_session(self) -> aiohttp.ClientSession:
+        """Получение общей HTTP-сессии с ограниченным пулом соединений."""
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._session_loop is not loop:
+            connector = aiohttp.TCPConnector(
+                limit=DB_POOL_SIZE,
+                keepalive_timeout=DB_KEEPALIVE_TIMEOUT
+            )
+            self._session = aiohttp.ClientSession(
+                headers=self.headers,
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=DB_TIMEOUT)
+            )
+            self._session_loop = loop
+        return self._session
+
+    async def close(self):
+        """Закрытие HTTP-сессии и пула соединений."""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        self._session_loop = None
+
+    async def _request(self, method: str, table: str, params=None, data=None, headers: dict = None):
+        """Выполнение запроса к PostgREST API Supabase."""
+        headers = dict(headers or {})
+        if method != "GET":
+            headers.setdefault("Prefer", "return=representation")
+        async with self.get_session().request(
+            method,
+            f"{self.rest_url}/{table}",
+            params=params,
+            json=data,
+            headers=headers
+        ) as response:
+            if response.status >= 400:
+                raise RuntimeError(f"{response.status}: {await response.text()}")
+            if response.status == 204:
+                return []
+            return await response.json()
+
+    @staticmethod
+    def _format_value(value) -> str:
+        """Преобразование значения в строку для фильтра PostgREST."""
+        if value is None:
+            return "null"
+        if isinstance(value, bool):
+            return str(value).lower()
+        if isinstance(value, datetime):
+            return value.isoformat()
+        return str(value)
+
+    @classmethod
+    def _in_filter(cls, values) -> str:
+        """Построение фильтра PostgREST вида in.(...) с экранированием значений."""
+        quoted = []
+        for value in values:
+            value = cls._format_value(value).replace('\\', '\\\\').replace('"', '\\"')
+            quoted.append(f'"{value}"')
+        return f"in.({','.join(quoted)})"
+
+    @classmethod
+    def _params(cls, filters: List[Filter]) -> list:
+        """Преобразование условий в параметры запроса PostgREST."""
+        return [
+            (column, cls._in_filter(value) if op == "in" else f"{op}.{cls._format_value(value)}")
+            for column, op, value in filters
+        ]
+
+    async def select(self, table, filters, columns="*", order=None, limit=None, offset=None) -> list:
+        params = [("select", columns)] + self._params(filters)
+        if order:
+            params.append(("order", order))
+        if limit is not None:
+            params.append(("limit", limit))
+        if offset:
+            params.append(("offset", offset))
+        return await self._request("GET", table, params)
+
+    async def count(self, table, filters) -> int:
+        async with self.get_session().head(
+            f"{self.rest_url}/{table}",
+            params=[("select", "id")] + self._params(filters),
+            headers={"Prefer": "count=exact"}
+        ) as response:
+            if response.status >= 400:
+                raise RuntimeError(f"{response.status}")
+            return int(response.headers.get("Content-Range", "*/0").split("/")[-1])
+
+    async def insert(self, table, data) -> list:
+        return await self._request("POST", table, data=data)
+
+    async def upsert(self, table, data, on_conflict, ignore_duplicates=False) -> list:
+        resolution = "ignore-duplicates" if ignore_duplicates else "merge-duplicates"
+        return await self._request(
+            "POST", table, [("on_conflict", on_conflict)], data,
+            headers={"Prefer": f"resolution={resolution},return=representation"}
+        )
+
+    async def update(self, table, filters, data) -> list:
+        return await self._request("PATCH", table, self._params(filters), data)
+
+    async def delete(self, table, filters) -> list:
+        return await self._request("DELETE", table, self._params(filters))
+
+    async def rpc(self, name, params):
+        try:
+            return await self._request("POST", f"rpc/{name}", data=params)
+        except RuntimeError as e:
+            if str(e).startswith("404"):
+                raise MissingFunctionError(str(e)) from e
+            raise
+
+# Схема, повторяющая таблицы Supabase вместе с миграциями из migrations/
+SQLITE_SCHEMA = """
+create table if not exists users (
+    id integer primary key autoincrement,
+    telegram_id integer unique,
+    username text,
+    chat_id integer,
+    capsule_counter integer not null default 0
+);
+create index if not exists users_username_idx on users (username);
+create table if not exists capsules (
+    id integer primary key autoincrement,
+    creator_id integer references users(id),
+    title text,
+    content text,
+    content_manifest text,
+    user_capsule_number integer,
+    created_at text default current_timestamp,
+    scheduled_at text,
+    is_sent integer not null default 0,
+    schedule_version integer not null default 0,
+    dispatch_task_id text,
+    dispatch_lease_until text
+);
+create index if not exists capsules_creator_idx on capsules (creator_id, id);
+create index if not exists capsules_due_idx on capsules (scheduled_at) where is_sent = 0;
+create table if not exists capsule_contents (
+    capsule_id integer primary key references capsules(id) on delete cascade,
+    content text not null
+);
+create table if not exists recipients (
+    id integer primary key autoincrement,
+    capsule_id integer references capsules(id),
+    recipient_username text,
+    unique (capsule_id, recipient_username)
+);
+"""
+JSON_COLUMNS = {"content_manifest"}
+BOOL_COLUMNS = {"is_sent"}
+DATETIME_COLUMNS = {"scheduled_at", "dispatch_lease_until"}
+SQL_OPERATORS = {"eq": "=", "neq": "!=", "gt": ">", "gte": ">=", "lt": "<", "lte": "<=", "like": "like", "ilike": "like"}
+IDENTIFIER = re.compile(r"^[a-z_][a-z0-9_]*$")
+
+def _utc_iso(value) -> str:
+    """Приведение даты к строке ISO в UTC, чтобы даты сравнивались как строки."""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc).isoformat()
+
+class SQLiteBackend(StorageBackend):
+    """Локальное хранилище SQLite (в памяти или в файле) для запуска без Supabase и нагрузочных тестов.
+
+    Хранимые функции из migrations/ реализованы здесь же на Python.
+    """
+
+    def __init__(self, path: str = ":memory:"):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("pragma foreign_keys = on")
+        self.conn.create_function("md5", 1, lambda value: hashlib.md5(value.encode('utf-8')).hexdigest(), deterministic=True)
+        self.conn.executescript(SQLITE_SCHEMA)
+        self.functions = {
+            "claim_due_capsules": self._claim_due_capsules,
+            "reschedule_capsule": self._reschedule_capsule,
+            "next_capsule_number": self._next_capsule_number,
+            "get_delivery_bundle": self._get_delivery_bundle,
+            "rotate_capsule_contents": self._rotate_capsule_contents
+        }
+
+    @staticmethod
+    def _identifier(name: str) -> str:
+        """Проверка имени таблицы или столбца перед подстановкой в SQL."""
+        name = name.strip()
+        if not IDENTIFIER.match(name):
+            raise ValueError(f"Недопустимое имя в запросе: {name}")
+        return name
+
+    @staticmethod
+    def _encode(column: str, value):
+        """Преобразование значения в формат хранения SQLite."""
+        if value is None:
+            return None
+        if column in JSON_COLUMNS:
+            return json.dumps(value, ensure_ascii=False)
+        if column in DATETIME_COLUMNS:
+            return _utc_iso(value)
+        if isinstance(value, bool):
+            return int(value)
+        if isinstance(value, datetime):
+            return value.isoformat()
+        return value
+
+    @staticmethod
+    def _decode(row: sqlite3.Row) -> dict:
+        """Преобразование строки SQLite в словарь, как его вернул бы PostgREST."""
+        result = dict(row)
+        for column, value in result.items():
+            if value is None:
+                continue
+            if column in JSON_COLUMNS:
+                result[column] = json.loads(value)
+            elif column in BOOL_COLUMNS:
+                result[column] = bool(value)
+        return result
+
+    def _where(self, filters: List[Filter]) -> Tuple[str, list]:
+        """Построение условия WHERE и его параметров."""
+        clauses, args = [], []
+        for column, op, value in filters:
+            column = self._identifier(column)
+            if op == "in":
+                values = list(value)
+                clauses.append(f"{column} in ({','.join('?' * len(values))})" if values else "0")
+                args.extend(self._encode(column, item) for item in values)
+            elif op == "is":
+                clauses.append(f"{column} is null" if value is None else f"{column} = ?")
+                if value is not None:
+                    args.append(int(value))
+            elif op in SQL_OPERATORS:
+                if op in ("like", "ilike"):
+                    value = str(value).replace("*", "%")
+                clauses.append(f"{column} {SQL_OPERATORS[op]} ?")
+                args.append(self._encode(column, value))
+            else:
+                raise ValueError(f"Неизвестный оператор фильтра: {op}")
+        return (" where " + " and ".join(clauses) if clauses else ""), args
+
+    def _order(self, order: str) -> str:
+        """Преобразование сортировки PostgREST ("id.desc,title") в ORDER BY."""
+        parts = []
+        for part in order.split(","):
+            column, _, direction = part.partition(".")
+            parts.append(f"{self._identifier(column)} {'desc' if direction.startswith('desc') else 'asc'}")
+        return " order by " + ", ".join(parts)
+
+    def _execute(self, sql: str, args=()) -> List[dict]:
+        with self.conn:
+            return [self._decode(row) for row in self.conn.execute(sql, args).fetchall()]
+
+    async def select(self, table, filters, columns="*", order=None, limit=None, offset=None) -> list:
+        if columns != "*":
+            columns = ",".join(self._identifier(column) for column in columns.split(","))
+        where, args = self._where(filters)
+        sql = f"select {columns} from {self._identifier(table)}{where}"
+        if order:
+            sql += self._order(order)
+        if limit is not None or offset:
+            sql += " limit ? offset ?"
+            args += [limit if limit is not None else -1, offset or 0]
+        return self._execute(sql, args)
+
+    async def count(self, table, filters) -> int:
+        where, args = self._where(filters)
+        return self.conn.execute(f"select count(*) from {self._identifier(table)}{where}", args).fetchone()[0]
+
+    def _insert_rows(self, table: str, data, conflict: str = "") -> List[dict]:
+        rows = data if isinstance(data, list) else [data]
+        result = []
+        with self.conn:
+            for row in rows:
+                columns = [self._identifier(column) for column in row]
+                sql = (
+                    f"insert into {self._identifier(table)} ({','.join(columns)}) "
+                    f"values ({','.join('?' * len(columns))}){conflict} returning *"
+                )
+                result.extend(
+                    self._decode(inserted)
+                    for inserted in self.conn.execute(sql, [self._encode(c, row[c]) for c in columns]).fetchall()
+                )
+        return result
+
+    async def insert(self, table, data) -> list:
+        return self._insert_rows(table, data)
+
+    async def upsert(self, table, data, on_conflict, ignore_duplicates=False) -> list:
+        keys = [self._identifier(column) for column in on_conflict.split(",")]
+        if ignore_duplicates:
+            return self._insert_rows(table, data, f" on conflict ({','.join(keys)}) do nothing")
+        rows = data if isinstance(data, list) else [data]
+        updates = [column for column in (rows[0] if rows else {}) if column not in keys]
+        action = (
+            "do update set " + ", ".join(f"{self._identifier(c)} = excluded.{self._identifier(c)}" for c in updates)
+            if updates else "do nothing"
+        )
+        return self._insert_rows(table, rows, f" on conflict ({','.join(keys)}) {action}")
+
+    async def update(self, table, filters, data) -> list:
+        where, args = self._where(filters)
+        assignments = ", ".join(f"{self._identifier(column)} = ?" for column in data)
+        values = [self._encode(column, value) for column, value in data.items()]
+        return self._execute(f"update {self._identifier(table)} set {assignments}{where} returning *", values + args)
+
+    async def delete(self, table, filters) -> list:
+        where, args = self._where(filters)
+        return self._execute(f"delete from {self._identifier(table)}{where} returning *", args)
+
+    async def rpc(self, name, params):
+        if name not in self.functions:
+            raise MissingFunctionError(f"404: функция {name} не найдена")
+        with self.conn:
+            return self.functions[name](**params)
+
+    async def close(self):
+        """Соединение SQLite не привязано к циклу событий и остаётся открытым до завершения процесса."""
+
+    def _claim_due_capsules(self, p_limit: int, p_lease_seconds: int) -> List[dict]:
+        now = datetime.now(timezone.utc)
+        due = self.conn.execute(
+            "select id from capsules where is_sent = 0 and scheduled_at <= ? "
+            "and (dispatch_lease_until is null or dispatch_lease_until < ?) "
+            "order by scheduled_at limit ?",
+            (now.isoformat(), now.isoformat(), p_limit)
+        ).fetchall()
+        lease_until = (now + timedelta(seconds=p_lease_seconds)).isoformat()
+        claimed = []
+        for row in due:
+            claimed.extend(self._decode(updated) for updated in self.conn.execute(
+                "update capsules set dispatch_lease_until = ?, dispatch_task_id = ? where id = ? "
+                "returning id, schedule_version, dispatch_task_id",
+                (lease_until, str(uuid.uuid4()), row['id'])
+            ).fetchall())
+        return claimed
+
+    def _reschedule_capsule(self, p_capsule_id: int, p_scheduled_at: str) -> List[dict]:
+        old = self.conn.execute("select dispatch_task_id from capsules where id = ?", (p_capsule_id,)).fetchone()
+        if old is None:
+            return []
+        updated = self.conn.execute(
+            "update capsules set scheduled_at = ?, is_sent = 0, dispatch_lease_until = null, "
+            "dispatch_task_id = null, schedule_version = schedule_version + 1 where id = ? "
+            "returning schedule_version",
+            (_utc_iso(p_scheduled_at), p_capsule_id)
+        ).fetchone()
+        return [{"schedule_version": updated['schedule_version'], "superseded_task_id": old['dispatch_task_id']}]
+
+    def _next_capsule_number(self, p_user_id: int) -> Optional[int]:
+        row = self.conn.execute(
+            "update users set capsule_counter = capsule_counter + 1 where id = ? returning capsule_counter",
+            (p_user_id,)
+        ).fetchone()
+        return row['capsule_counter'] if row else None
+
+    def _get_delivery_bundle(self, p_capsule_id: int) -> Optional[dict]:
+        capsule = self.conn.execute(
+            "select c.id, c.creator_id, c.is_sent, c.schedule_version, u.username as sender_username, "
+            "coalesce(cc.content, c.content) as content "
+            "from capsules c "
+            "left join users u on u.id = c.creator_id "
+            "left join capsule_contents cc on cc.capsule_id = c.id "
+            "where c.id = ?",
+            (p_capsule_id,)
+        ).fetchone()
+        if capsule is None:
+            return None
+        recipients = self.conn.execute(
+            "select r.recipient_username as username, "
+            "(select ru.chat_id from users ru where ru.username = r.recipient_username limit 1) as chat_id "
+            "from recipients r where r.capsule_id = ?",
+            (p_capsule_id,)
+        ).fetchall()
+        return {**self._decode(capsule), "recipients": [dict(row) for row in recipients]}
+
+    def _rotate_capsule_contents(self, p_rows: List[dict]) -> int:
+        updated = 0
+        for row in p_rows:
+            updated += self.conn.execute(
+                "update capsule_contents set content = ? where capsule_id = ? and md5(content) = ?",
+                (row['content'], row['capsule_id'], row['old_hash'])
+            ).rowcount
+        return updated
+
+def create_backend() -> StorageBackend:
+    """Создание хранилища, выбранного переменной STORAGE_BACKEND."""
+    if STORAGE_BACKEND == "sqlite":
+        logger.info(f"Используется локальное хранилище SQLite: {SQLITE_PATH}")
+        return SQLiteBackend(SQLITE_PATH)
+    if STORAGE_BACKEND == "supabase":
+        return SupabaseBackend(SUPABASE_REST_URL, SUPABASE_HEADERS)
+    logger.error(f"Неизвестное хранилище STORAGE_BACKEND={STORAGE_BACKEND}: допустимы supabase и sqlite")
+    sys.exit(1)
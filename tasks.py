@@ -1,69 +1,297 @@
 from celery import Celery
+from celery.signals import worker_process_init, worker_process_shutdown, worker_shutdown
 import asyncio
-import json
+import os
 from datetime import datetime
 from typing import List, Optional
 import pytz
+import redis.asyncio as aioredis
 from telegram import Bot
-from telegram.ext import Application
-from config import logger, TELEGRAM_TOKEN, ENCRYPTION_KEY_BYTES, celery_app
+from telegram.request import HTTPXRequest
+from config import (
+    logger, TELEGRAM_TOKEN, BOT_POOL_SIZE, celery_app, REDIS_URL,
+    SWEEP_BATCH_SIZE, SWEEP_MAX_BATCHES, DISPATCH_LEASE_SECONDS,
+    DELIVERY_MAX_RETRIES, DELIVERY_RETRY_BACKOFF, REENCRYPT_BATCH_SIZE, REENCRYPT_MAX_BATCHES,
+    REENCRYPT_LOCK_SECONDS
+)
 from localization import t
-from database import fetch_data, delete_capsule, get_capsule_recipients, get_chat_id, update_data
-from crypto import decrypt_data_aes
+from database import (
+    delete_capsule, update_data, close_session, claim_due_capsules, get_delivery_bundle,
+    get_capsule_contents_batch, rotate_capsule_contents, unschedule_capsule, get_capsule_schedule,
+    extend_dispatch_lease
+)
+from crypto import decrypt_content_async, shutdown_pools, offload, reencrypt_batch, keys
+from delivery import DeliveryEngine, DeliveryLedger, RedisLock, build_content_items, FAILED
 
-@celery_app.task(name='main.send_capsule_task')
-def send_capsule_task(capsule_id: int):
+REENCRYPT_LOCK_KEY = "reencrypt_lock"
+
+_worker_loop: Optional[asyncio.AbstractEventLoop] = None
+_worker_bot: Optional[Bot] = None
+_worker_engine: Optional[DeliveryEngine] = None
+_worker_redis: Optional[aioredis.Redis] = None
+_worker_pid: Optional[int] = None
+
+def get_worker_loop() -> asyncio.AbstractEventLoop:
+    """Получение event loop и Bot-клиента текущего процесса воркера."""
+    global _worker_loop, _worker_bot, _worker_engine, _worker_redis, _worker_pid
+    if _worker_loop is None or _worker_loop.is_closed() or _worker_pid != os.getpid():
+        loop = asyncio.new_event_loop()
+        bot = Bot(TELEGRAM_TOKEN, request=HTTPXRequest(connection_pool_size=BOT_POOL_SIZE))
+        try:
+            loop.run_until_complete(bot.initialize())
+        except Exception:
+            loop.close()
+            raise
+        asyncio.set_event_loop(loop)
+        _worker_loop, _worker_bot, _worker_pid = loop, bot, os.getpid()
+        _worker_engine = DeliveryEngine(bot)
+        _worker_redis = aioredis.from_url(REDIS_URL)
+        logger.info(f"Bot-клиент воркера инициализирован (pid {_worker_pid})")
+    return _worker_loop
+
+def get_worker_engine() -> DeliveryEngine:
+    """Получение движка доставки текущего процесса воркера."""
+    get_worker_loop()
+    return _worker_engine
+
+def get_worker_redis() -> aioredis.Redis:
+    """Получение асинхронного клиента Redis текущего процесса воркера."""
+    get_worker_loop()
+    return _worker_redis
+
+def run_in_worker_loop(coro):
+    """Выполнение корутины в event loop процесса воркера."""
+    return get_worker_loop().run_until_complete(coro)
+
+@worker_process_init.connect
+def init_worker_process(**kwargs):
+    """Создание Bot-клиента при запуске процесса воркера."""
+    try:
+        get_worker_loop()
+    except Exception as e:
+        logger.error(f"Не удалось инициализировать Bot-клиент воркера: {e}")
+
+@worker_process_shutdown.connect
+@worker_shutdown.connect
+def shutdown_worker_process(**kwargs):
+    """Закрытие Bot-клиента, соединений и event loop при остановке воркера."""
+    global _worker_loop, _worker_bot, _worker_engine, _worker_redis, _worker_pid
+    if _worker_loop is None or _worker_loop.is_closed() or _worker_pid != os.getpid():
+        return
+    try:
+        _worker_loop.run_until_complete(_worker_bot.shutdown())
+        _worker_loop.run_until_complete(_worker_engine.close())
+        _worker_loop.run_until_complete(_worker_redis.aclose())
+        _worker_loop.run_until_complete(close_session())
+        shutdown_pools()
+    except Exception as e:
+        logger.error(f"Ошибка при остановке Bot-клиента воркера: {e}")
+    finally:
+        _worker_loop.close()
+        _worker_loop = None
+        _worker_bot = None
+        _worker_engine = None
+        _worker_redis = None
+        _worker_pid = None
+        logger.info(f"Bot-клиент воркера остановлен (pid {os.getpid()})")
+
+def _parse_time(value: Optional[str]) -> Optional[datetime]:
+    """Разбор даты ISO из хранилища."""
+    return datetime.fromisoformat(value) if value else None
+
+def is_task_current(schedule: dict, schedule_version: Optional[int]) -> bool:
+    """Актуальна ли задача отправки для текущего расписания капсулы.
+
+    Задачи без версии остались от старых ETA-задач: они актуальны, только если
+    срок отправки наступил и капсулу не забрал планировщик.
+    """
+    if schedule_version is not None:
+        return schedule['schedule_version'] == schedule_version
+    now = datetime.now(pytz.utc)
+    scheduled_at = _parse_time(schedule['scheduled_at'])
+    lease_until = _parse_time(schedule['dispatch_lease_until'])
+    return scheduled_at is not None and scheduled_at <= now and (lease_until is None or lease_until < now)
+
+async def keep_delivery_lease(ledger: DeliveryLedger, capsule_id: int, delivery: asyncio.Future):
+    """Продление блокировки и аренды капсулы, пока идёт отправка.
+
+    Если блокировку захватила другая задача, отправка прерывается, чтобы элементы не ушли дважды.
+    """
+    while True:
+        await asyncio.sleep(DISPATCH_LEASE_SECONDS / 3)
+        try:
+            if not await ledger.extend(DISPATCH_LEASE_SECONDS):
+                logger.error(f"Блокировка отправки капсулы {capsule_id} потеряна, отправка прервана")
+                delivery.cancel()
+                return
+            await extend_dispatch_lease(capsule_id, DISPATCH_LEASE_SECONDS)
+        except Exception as e:
+            logger.warning(f"Не удалось продлить аренду капсулы {capsule_id}: {e}")
+
+@celery_app.task(bind=True, name='main.send_capsule_task', max_retries=DELIVERY_MAX_RETRIES)
+def send_capsule_task(self, capsule_id: int, schedule_version: Optional[int] = None):
     """Задача Celery для отправки капсулы."""
-    async def send_async():
+    async def send_async() -> bool:
+        """Отправка капсулы; возвращает True, если нужна повторная попытка."""
+        # Устаревшие задачи отбрасываются до блокировки и без загрузки содержимого
         try:
-            logger.info(f"Начинаю отправку капсулы {capsule_id}")
-            capsule = fetch_data("capsules", {"id": capsule_id})
-            if not capsule:
+            schedule = await get_capsule_schedule(capsule_id)
+        except Exception as e:
+            logger.error(f"Не удалось прочитать расписание капсулы {capsule_id}: {e}")
+            return True
+        if not schedule:
+            logger.error(f"Капсула {capsule_id} не найдена")
+            return False
+
+        if not is_task_current(schedule, schedule_version):
+            logger.info(f"Задача для капсулы {capsule_id} устарела (версия {schedule_version}), пропускаю")
+            return False
+
+        if schedule['is_sent']:
+            logger.info(f"Капсула {capsule_id} уже была отправлена")
+            return False
+
+        ledger = DeliveryLedger(get_worker_redis(), capsule_id)
+        if not await ledger.acquire(DISPATCH_LEASE_SECONDS):
+            logger.info(f"Капсула {capsule_id} уже отправляется другой задачей")
+            return False
+        try:
+            bundle = await get_delivery_bundle(capsule_id)
+            if not bundle:
                 logger.error(f"Капсула {capsule_id} не найдена")
-                return
+                await unschedule_capsule(capsule_id, schedule['schedule_version'])
+                return False
 
-            if capsule[0]['is_sent']:
-                logger.info(f"Капсула {capsule_id} уже была отправлена")
-                return
+            # Пока задача ждала блокировку, капсулу могли отправить или перенести
+            if bundle['is_sent'] or bundle['schedule_version'] != schedule['schedule_version']:
+                logger.info(f"Капсула {capsule_id} уже отправлена или перенесена, пропускаю")
+                return False
 
-            content = json.loads(decrypt_data_aes(capsule[0]['content'], ENCRYPTION_KEY_BYTES))
-            recipients = get_capsule_recipients(capsule_id)
-            if not recipients:
-                logger.error(f"Нет получателей для капсулы {capsule_id}")
-                return
+            logger.info(f"Начинаю отправку капсулы {capsule_id}")
+            if not bundle['content']:
+                logger.error(f"Содержимое капсулы {capsule_id} не найдено, капсула снята с расписания")
+                await unschedule_capsule(capsule_id, bundle['schedule_version'])
+                return False
+            content = await decrypt_content_async(bundle['content'])
+            if not bundle['recipients']:
+                logger.error(f"Нет получателей для капсулы {capsule_id}, капсула снята с расписания")
+                await unschedule_capsule(capsule_id, bundle['schedule_version'])
+                return False
 
-            bot = Application.builder().token(TELEGRAM_TOKEN).build()
-            await bot.initialize()
-            creator = fetch_data("users", {"id": capsule[0]['creator_id']})
-            sender_username = creator[0]['username'] if creator else "Unknown"
-
-            for recipient in recipients:
-                chat_id = get_chat_id(recipient['recipient_username'])
-                if chat_id:
-                    await bot.bot.send_message(
-                        chat_id=chat_id,
-                        text=t('capsule_received', sender=sender_username)
-                    )
-                    for item in content.get('text', []):
-                        await bot.bot.send_message(chat_id, item)
-                    for item in content.get('stickers', []):
-                        await bot.bot.send_sticker(chat_id, item)
-                    for item in content.get('photos', []):
-                        await bot.bot.send_photo(chat_id, item)
-                    for item in content.get('documents', []):
-                        await bot.bot.send_document(chat_id, item)
-                    for item in content.get('voices', []):
-                        await bot.bot.send_voice(chat_id, item)
-                    for item in content.get('videos', []):
-                        await bot.bot.send_video(chat_id, item)
-                    for item in content.get('audios', []):
-                        await bot.bot.send_audio(chat_id, item)
+            sender_username = bundle['sender_username'] or "Unknown"
+            chat_ids = {}
+            for recipient in bundle['recipients']:
+                if recipient['chat_id']:
+                    chat_ids[recipient['username']] = recipient['chat_id']
                 else:
-                    logger.warning(f"Получатель {recipient['recipient_username']} не зарегистрирован")
+                    logger.warning(f"Получатель {recipient['username']} не зарегистрирован")
 
+            items = [('text', t('capsule_received', sender=sender_username))] + build_content_items(content)
+            delivery = asyncio.ensure_future(get_worker_engine().deliver(list(chat_ids.values()), items, ledger))
+            heartbeat = asyncio.ensure_future(keep_delivery_lease(ledger, capsule_id, delivery))
+            try:
+                results = await delivery
+            except asyncio.CancelledError:
+                return False
+            finally:
+                heartbeat.cancel()
+            failed = [chat_id for chat_id, status in results.items() if status == FAILED]
+            if failed:
+                logger.error(f"Капсула {capsule_id} не доставлена в чаты: {failed}")
+                return True
+
+            # Журнал очищается только после отметки в хранилище: повтор не отправит уже доставленное
+            if not await update_data("capsules", {"id": capsule_id}, {"is_sent": True}):
+                logger.error(f"Не удалось отметить капсулу {capsule_id} отправленной")
+                return True
+            await ledger.clear()
             logger.info(f"Капсула {capsule_id} успешно отправлена")
-            update_data("capsules", {"id": capsule_id}, {"is_sent": True})
+            return False
         except Exception as e:
             logger.error(f"Ошибка в задаче отправки капсулы {capsule_id}: {e}")
+            return True
+        finally:
+            await ledger.release()
+
+    if run_in_worker_loop(send_async()):
+        countdown = DELIVERY_RETRY_BACKOFF * 2 ** self.request.retries
+        logger.info(f"Повторная отправка капсулы {capsule_id} через {countdown} с")
+        # Аренда покрывает ожидание повтора, иначе планировщик заберёт капсулу раньше и отправит её второй задачей
+        if self.request.retries < self.max_retries:
+            run_in_worker_loop(extend_dispatch_lease(capsule_id, countdown + DISPATCH_LEASE_SECONDS, schedule_version))
+        try:
+            raise self.retry(countdown=countdown)
+        except self.MaxRetriesExceededError:
+            logger.error(f"Капсула {capsule_id} не отправлена после {self.max_retries} попыток, капсула снята с расписания")
+            run_in_worker_loop(unschedule_capsule(capsule_id, schedule_version))
+
+@celery_app.task(name='main.dispatch_due_capsules')
+def dispatch_due_capsules():
+    """Периодическая задача Celery: передача наступивших капсул на отправку."""
+    async def dispatch_async():
+        dispatched = 0
+        for _ in range(SWEEP_MAX_BATCHES):
+            capsules = await claim_due_capsules(SWEEP_BATCH_SIZE, DISPATCH_LEASE_SECONDS)
+            for capsule in capsules:
+                send_capsule_task.apply_async(
+                    args=[capsule['id'], capsule['schedule_version']],
+                    task_id=capsule['dispatch_task_id']
+                )
+            dispatched += len(capsules)
+            if len(capsules) < SWEEP_BATCH_SIZE:
+                break
+        if dispatched:
+            logger.info(f"Передано на отправку капсул: {dispatched}")
+
+    run_in_worker_loop(dispatch_async())
+
+@celery_app.task(name='main.reencrypt_capsules')
+def reencrypt_capsules():
+    """Фоновое перешифрование содержимого капсул текущим ключом.
+
+    Капсулы обходятся пачками по возрастанию capsule_id; после каждой пачки
+    позиция сохраняется в Redis, поэтому задача продолжает с места остановки.
+    За один запуск обрабатывается не больше REENCRYPT_MAX_BATCHES пачек,
+    после чего задача ставит себя в очередь снова.
+    """
+    async def reencrypt_async() -> bool:
+        """Перешифрование очередных пачек; возвращает True, если обход не закончен."""
+        redis_client = get_worker_redis()
+        lock = RedisLock(redis_client, REENCRYPT_LOCK_KEY)
+        if not await lock.acquire(REENCRYPT_LOCK_SECONDS):
+            logger.info("Перешифрование уже выполняется другой задачей")
+            return False
+        checkpoint_key = f"reencrypt_checkpoint:{keys.current_id}"
+        try:
+            last_id = int(await redis_client.get(checkpoint_key) or 0)
+            for batch in range(REENCRYPT_MAX_BATCHES):
+                # Блокировка продлевается перед каждой пачкой; если её захватила другая задача, обход прерывается
+                if batch and not await lock.extend(REENCRYPT_LOCK_SECONDS):
+                    logger.error(f"Блокировка перешифрования потеряна после капсулы {last_id}, обход прерван")
+                    return False
+                try:
+                    rows = await get_capsule_contents_batch(last_id, REENCRYPT_BATCH_SIZE)
+                except Exception as e:
+                    logger.error(f"Не удалось прочитать капсулы для перешифрования после {last_id}, обход прерван: {e}")
+                    return False
+                if not rows:
+                    await redis_client.delete(checkpoint_key)
+                    logger.info(f"Перешифрование ключом {keys.current_id} завершено")
+                    return False
+                updates = await offload(reencrypt_batch, rows, size=sum(len(row['content']) for row in rows))
+                if updates:
+                    written = await rotate_capsule_contents(updates)
+                    if written is None:
+                        logger.error(f"Не удалось записать перешифрованные капсулы после {last_id}, обход прерван")
+                        return False
+                    if written < len(updates):
+                        logger.info(f"Капсул изменено во время перешифрования: {len(updates) - written}")
+                last_id = rows[-1]['capsule_id']
+                await redis_client.set(checkpoint_key, last_id)
+            logger.info(f"Перешифрование ключом {keys.current_id}: обработаны капсулы до {last_id}")
+            return True
+        finally:
+            await lock.release()
 
-    asyncio.run(send_async())
+    if run_in_worker_loop(reencrypt_async()):
+        reencrypt_capsules.apply_async()
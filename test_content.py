@@ -0,0 +1,53 @@
+import json
+import unittest
+from content import (
+    FORMAT_SEPARATED, FORMAT_LENGTHS, encode_content, decode_content, to_items, add_item, count_items
+)
+
+ITEMS = [
+    ('text', "Привет из прошлого!"),
+    ('photos', "AgACAgIAAxkBAAIBZ2Zphoto"),
+    ('text', ""),
+    ('photos', "AgACAgIAAxkBAAIBaGZphoto"),
+    ('stickers', "CAACAgIAAxkBAAIBsticker"),
+    ('text', "😀 " * 3000)
+]
+
+class ContentFormatTest(unittest.TestCase):
+    """Компактный формат содержимого капсулы и чтение старого JSON."""
+
+    def test_round_trip_keeps_order(self):
+        encoded = encode_content(ITEMS)
+        self.assertEqual(encoded[0], FORMAT_SEPARATED)
+        self.assertEqual(decode_content(encoded), ITEMS)
+
+    def test_empty_content(self):
+        self.assertEqual(decode_content(encode_content([])), [])
+
+    def test_values_with_separator(self):
+        items = [('text', "до\x00после"), ('documents', "file-id")]
+        encoded = encode_content(items)
+        self.assertEqual(encoded[0], FORMAT_LENGTHS)
+        self.assertEqual(decode_content(encoded), items)
+
+    def test_legacy_json(self):
+        legacy = {"text": ["Открой через год"], "photos": ["p1", "p2"], "videos": []}
+        expected = [('text', "Открой через год"), ('photos', "p1"), ('photos', "p2")]
+        self.assertEqual(decode_content(json.dumps(legacy, ensure_ascii=False)), expected)
+        self.assertEqual(decode_content(json.dumps(legacy).encode('utf-8')), expected)
+        self.assertEqual(to_items(legacy), expected)
+        self.assertEqual(decode_content(encode_content(legacy)), expected)
+
+    def test_unknown_version(self):
+        with self.assertRaises(ValueError):
+            decode_content(b"\x7f\x00\x00\x00\x00")
+
+    def test_add_item_and_counts(self):
+        content = add_item(None, 'text', "первый")
+        content = add_item(content, 'photos', "p1")
+        content = add_item(content, 'text', "второй")
+        self.assertEqual(to_items(content), [('text', "первый"), ('photos', "p1"), ('text', "второй")])
+        self.assertEqual(count_items(to_items(content)), {'text': 2, 'photos': 1})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,10 +1,19 @@
-import json
+import asyncio
+import functools
+import uuid
 from datetime import datetime
+from typing import Dict
+import redis.asyncio as aioredis
 from telegram.ext import Application, CallbackContext
 from telegram import Update
-from config import logger, celery_app
-from database import fetch_data, create_capsule, delete_capsule, generate_unique_capsule_number, update_data, edit_capsule
+from config import logger, celery_app, REDIS_URL, SWEEP_INTERVAL
+from database import (
+    create_capsule, delete_capsule, generate_unique_capsule_number,
+    close_session, reschedule_capsule, save_content, begin_unit_of_work, get_capsule_meta,
+    get_user_by_telegram_id, get_cache_stats, get_query_stats
+)
 from localization import t
+from crypto import shutdown_pools, get_pool_stats
 import pytz
 
 CREATING_CAPSULE_TITLE = "creating_capsule_title"
@@ -13,10 +22,39 @@ CREATING_CAPSULE_RECIPIENTS = "creating_capsule_recipients"
 CREATING_CAPSULE_DATE = "creating_capsule_date"
 SELECTING_CAPSULE = "selecting_capsule"
 SELECTING_CAPSULE_FOR_RECIPIENTS = "selecting_capsule_for_recipients"
+STARTUP_SWEEP_KEY = "startup_sweep_task"
+
+# Очереди апдейтов пользователей: user_id -> блокировка и число апдейтов, которые её ждут или держат
+_user_locks: Dict[int, asyncio.Lock] = {}
+_user_lock_users: Dict[int, int] = {}
+
+def sequential_per_user(callback):
+    """Обработка апдейтов одного пользователя по очереди.
+
+    Бот обрабатывает апдейты параллельно, а мастер создания капсулы читает и
+    изменяет context.user_data между await. Апдейты разных пользователей
+    по-прежнему обрабатываются одновременно.
+    """
+    @functools.wraps(callback)
+    async def wrapper(update: Update, context: CallbackContext):
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            return await callback(update, context)
+        lock = _user_locks.setdefault(user.id, asyncio.Lock())
+        _user_lock_users[user.id] = _user_lock_users.get(user.id, 0) + 1
+        try:
+            async with lock:
+                return await callback(update, context)
+        finally:
+            _user_lock_users[user.id] -= 1
+            if not _user_lock_users[user.id]:
+                del _user_lock_users[user.id]
+                del _user_locks[user.id]
+    return wrapper
 
 async def check_capsule_ownership(update: Update, capsule_id: int, query=None) -> bool:
     """Проверка владения капсулой."""
-    user = fetch_data("users", {"telegram_id": update.effective_user.id})
+    user = await get_user_by_telegram_id(update.effective_user.id)
     if not user:
         if query:
             await query.edit_message_text(t('not_registered'))
@@ -24,8 +62,8 @@ async def check_capsule_ownership(update: Update, capsule_id: int, query=None) -
             await update.message.reply_text(t('not_registered'))
         return False
 
-    capsule = fetch_data("capsules", {"id": capsule_id})
-    if not capsule or capsule[0]['creator_id'] != user[0]['id']:
+    capsule = await get_capsule_meta(capsule_id)
+    if not capsule or capsule['creator_id'] != user['id']:
         if query:
             await query.edit_message_text(t('not_your_capsule'))
         else:
@@ -34,13 +72,10 @@ async def check_capsule_ownership(update: Update, capsule_id: int, query=None) -
 
     return True
 
-def save_capsule_content(context: CallbackContext, capsule_id: int):
+async def save_capsule_content(context: CallbackContext, capsule_id: int):
     """Сохранение содержимого капсулы."""
-    from crypto import encrypt_data_aes
-    content = context.user_data.get('capsule_content', {})
-    json_str = json.dumps(content, ensure_ascii=False)
-    encrypted = encrypt_data_aes(json_str)
-    update_data("capsules", {"id": capsule_id}, {"content": encrypted})
+    content = context.user_data.get('capsule_content', [])
+    await save_content(capsule_id, content)
 
 def convert_to_utc(local_time_str: str, timezone: str = 'Europe/Moscow') -> datetime:
     """Конвертация местного времени в UTC."""
@@ -55,30 +90,30 @@ def convert_to_utc(local_time_str: str, timezone: str = 'Europe/Moscow') -> date
 
 async def post_init(application: Application):
     """Инициализация задач после запуска бота."""
-    logger.info("Начало инициализации задач")
+    logger.info("Запуск проверки капсул, время отправки которых наступило")
     try:
-        capsules = fetch_data("capsules")
-        logger.info(f"Найдено {len(capsules)} капсул в базе данных")
-
-        now = datetime.now(pytz.utc)
-        logger.info(f"Текущее время UTC: {now}")
-
-        for capsule in capsules:
-            if capsule.get('scheduled_at') and not capsule.get('is_sent'):
-                scheduled_at = datetime.fromisoformat(capsule['scheduled_at']).replace(tzinfo=pytz.utc)
-                logger.info(f"Обработка капсулы {capsule['id']}, запланированной на {scheduled_at}")
-
-                if scheduled_at > now:
-                    logger.info(f"Добавление задачи для капсулы {capsule['id']} в Celery")
-                    celery_app.send_task(
-                        'main.send_capsule_task',
-                        args=[capsule['id']],
-                        eta=scheduled_at
-                    )
-                    logger.info(f"Задача для капсулы {capsule['id']} запланирована на {scheduled_at}")
-        logger.info("Инициализация задач завершена")
+        task_id = str(uuid.uuid4())
+        async with aioredis.from_url(REDIS_URL) as redis_client:
+            if not await redis_client.set(STARTUP_SWEEP_KEY, task_id, nx=True, ex=max(1, int(SWEEP_INTERVAL))):
+                logger.info("Проверка капсул уже поставлена в очередь, пропускаю")
+                return
+        celery_app.send_task('main.dispatch_due_capsules', task_id=task_id, expires=SWEEP_INTERVAL)
+        logger.info(f"Проверка капсул запущена задачей {task_id}")
     except Exception as e:
-        logger.error(f"Не удалось инициализировать задачи: {e}")
+        logger.error(f"Не удалось запустить проверку капсул: {e}")
+
+async def start_unit_of_work(update: Update, context: CallbackContext):
+    """Открытие identity map для чтений из базы в рамках одного апдейта."""
+    begin_unit_of_work()
+
+async def post_shutdown(application: Application):
+    """Освобождение ресурсов при остановке бота."""
+    engine = application.bot_data.get('delivery_engine')
+    if engine:
+        await engine.close()
+    await close_session()
+    shutdown_pools()
+    logger.info(f"Соединения с базой данных закрыты, статистика кэшей: {get_cache_stats()}, запросов: {get_query_stats()}, очередь шифрования: {get_pool_stats()}")
 
 async def check_bot_permissions(context: CallbackContext):
     """Проверка прав бота."""
@@ -98,7 +133,7 @@ async def save_send_date(update: Update, context: CallbackContext, send_date: da
 
         send_date = send_date.astimezone(pytz.utc)
 
-        capsule = fetch_data("capsules", {"id": capsule_id})
+        capsule = await get_capsule_meta(capsule_id)
         if not capsule:
             if is_message:
                 await update.message.reply_text(t('invalid_capsule_id'))
@@ -106,13 +141,13 @@ async def save_send_date(update: Update, context: CallbackContext, send_date: da
                 await update.callback_query.edit_message_text(t('invalid_capsule_id'))
             return
 
-        edit_capsule(capsule_id, scheduled_at=send_date)
-        celery_app.send_task(
-            'main.send_capsule_task',
-            args=[capsule_id],
-            eta=send_date
-        )
-        logger.info(f"Задача для капсулы {capsule_id} запланирована на {send_date}")
+        schedule = await reschedule_capsule(capsule_id, send_date)
+        if not schedule:
+            raise RuntimeError("не удалось обновить расписание")
+        if schedule['superseded_task_id']:
+            await asyncio.to_thread(celery_app.control.revoke, schedule['superseded_task_id'])
+            logger.info(f"Задача {schedule['superseded_task_id']} для капсулы {capsule_id} отменена")
+        logger.info(f"Капсула {capsule_id} запланирована на {send_date} (версия {schedule['schedule_version']})")
 
         message_text = t('date_set', date=send_date.astimezone(pytz.timezone('Europe/Moscow')).strftime('%d.%m.%Y %H:%M'))
         if is_message: